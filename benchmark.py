@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of template rendering and Json codecs, run it in the root dir of this package
+"""
+__author__ = 'shajunxing'
+
+import logging
+import json
+import os
+import timeit
+import tornado.template
+import tore.codec
+import tore.messaging
+import tore.web
+
+NUMBER = 10000
+
+# code files of ancestors and self compiled into one, see old_generate
+_old_sources = {}
+
+
+def old_generate(template, **kwargs):
+    """
+    how tore.web.Template.generate worked before, the code is formatted for every rendering, and code files are
+    executed for every rendering
+    """
+    formatted_code = tornado.template._format_code(template.code).rstrip()
+    logging.debug("%s code:\n%s", template.name, formatted_code)
+    if template.name not in _old_sources:
+        ancestors = reversed(template._get_ancestors(template.loader))
+        source = '\n\n'.join(ancestor.template.source_string for ancestor in ancestors)
+        _old_sources[template.name] = compile(source, template.name, 'exec')
+    namespace = dict(template.base_namespace)
+    namespace.update(kwargs)
+    exec(template.compiled, namespace)
+    exec(_old_sources[template.name], namespace)
+    return namespace['_execute']()
+
+
+def new_generate(template, **kwargs):
+    return template.generate(**kwargs)
+
+
+def benchmark(name, generate):
+    loader = tore.web.create_loader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web'), {})
+    template = loader.load(name)
+    seconds = timeit.timeit(lambda: generate(template, current_user='user'), number=NUMBER)
+    return NUMBER / seconds
+
+
+# typical message content and Json handler response
+_content = {
+    'id': 12345,
+    'name': 'sensor-01',
+    'values': [i * 0.5 for i in range(50)],
+    'tags': {'building': 'A', 'floor': 3, 'room': '301'},
+    'updated': '2024-01-01T00:00:00',
+    'ok': True
+}
+
+_match = ['/sensors/sensor-01/temperature', 'sensor-01', 'temperature']
+
+_body = json.dumps(_content).encode()
+
+
+def old_frame():
+    """
+    how tore.messaging.message_frame worked before
+    """
+    return json.dumps({'type': 'message', 'match': _match, 'content': _content}, ensure_ascii=False).encode()
+
+
+def new_frame():
+    return tore.messaging.message_frame(_content, _match)
+
+
+def old_handler():
+    """
+    how write_json_object and get_body_as_object worked before
+    """
+    json.loads(_body.decode())
+    return json.dumps(_content).encode()
+
+
+def new_handler():
+    tore.codec.loads(_body)
+    return tore.codec.dumps(_content)
+
+
+def rate(func):
+    return NUMBER / timeit.timeit(func, number=NUMBER)
+
+
+if __name__ == '__main__':
+    for name in ('ex2.t', 'ex3.t'):
+        old = benchmark(name, old_generate)
+        new = benchmark(name, new_generate)
+        print('%s: %.0f pages/s before, %.0f pages/s after, %.2fx' % (name, old, new, new / old))
+    for codec in tore.codec.CODECS:
+        try:
+            tore.codec.select(codec)
+        except Exception as ex:
+            print(ex)
+            continue
+        for name, old, new in (('message frame', old_frame, new_frame), ('Json handler', old_handler, new_handler)):
+            before = rate(old)
+            after = rate(new)
+            print('%s with %s: %.0f/s before, %.0f/s after, %.2fx' % (name, codec, before, after, after / before))
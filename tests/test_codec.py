@@ -0,0 +1,24 @@
+import unittest
+
+import tore.codec
+
+
+class CodecTest(unittest.TestCase):
+    def tearDown(self):
+        tore.codec.select()
+
+    def test_big_integer(self):
+        for codec in tore.codec.CODECS:
+            try:
+                tore.codec.select(codec)
+            except Exception:
+                continue
+            self.assertEqual(tore.codec.dumps({'n': 2 ** 70}), b'{"n":1180591620717411303424}')
+
+    def test_json_keeps_big_integer(self):
+        tore.codec.select('json')
+        self.assertEqual(tore.codec.loads(b'123456789012345678901234567890'), 123456789012345678901234567890)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import time
+import unittest
+
+import tornado.ioloop
+
+import tore.messaging
+
+
+class FakeStream():
+    """
+    stream of a subscriber, written data is sent at once unless "slow" is set
+    """
+
+    def __init__(self):
+        self.slow = False
+
+    def closed(self):
+        return False
+
+    def writing(self):
+        return self.slow
+
+    def write(self, data, callback=None):
+        if callback and not self.slow:
+            tornado.ioloop.IOLoop.instance().add_callback(callback)
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = FakeStream()
+        self.received = []
+        self.outbox = tore.messaging._Outbox(self.stream, self.received.extend, lambda: None)
+
+    def run_loop(self, seconds=0.3):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_timeout(time.time() + seconds, io_loop.stop)
+        io_loop.start()
+
+    def put(self, count):
+        for i in range(count):
+            self.outbox.put(tore.messaging._MessageFrame(i, ['/d']))
+
+    def test_fast_subscriber_receives_all(self):
+        # more frames than queue size in one ioloop iteration, such as a publish_batch
+        self.put(tore.messaging.DEFAULT_QUEUE_SIZE * 2 + 1)
+        self.run_loop()
+        self.assertEqual([f.content for f in self.received], list(range(tore.messaging.DEFAULT_QUEUE_SIZE * 2 + 1)))
+        self.assertEqual(self.outbox.dropped, 0)
+
+    def test_fast_subscriber_receives_all_across_iterations(self):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        for i in range(3):
+            io_loop.add_callback(lambda: self.put(tore.messaging.DEFAULT_QUEUE_SIZE))
+        self.run_loop()
+        self.assertEqual(len(self.received), tore.messaging.DEFAULT_QUEUE_SIZE * 3)
+        self.assertEqual(self.outbox.dropped, 0)
+
+    def test_slow_subscriber_drops(self):
+        self.stream.slow = True
+        self.put(1)
+        self.run_loop(0.05)
+        # the first frame is written, and the stream is never drained
+        self.put(tore.messaging.DEFAULT_QUEUE_SIZE + 10)
+        self.run_loop(0.05)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.outbox.dropped, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
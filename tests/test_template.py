@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import tore.web
+
+FILES = {
+    'base.t': '{{ deco() }}|{{ K().m() }}|{% block b %}{% end %}',
+    'base.t.py': '''
+import functools
+
+def wrap(f):
+    @functools.wraps(f)
+    def w(*args):
+        return f(*args)
+    return w
+
+def who():
+    return 'base'
+
+@wrap
+def deco():
+    return 'deco:' + who()
+
+class K():
+    def m(self):
+        return 'meth:' + who()
+
+@cached(60, key=lambda: current_user)
+def user():
+    return current_user
+''',
+    'child.t': '{% extends "base.t" %}{% block b %}{{ user() }}{% end %}',
+    'child.t.py': '''
+def who():
+    return 'CHILD'
+''',
+}
+
+
+class CodeFileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name, content in FILES.items():
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(content)
+        self.loader = tore.web.Loader(self.root, stream_chunk_size=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_child_overrides_names_of_parent_code_file(self):
+        self.assertEqual(self.loader.load('child.t').generate(current_user='alice'), b'deco:CHILD|meth:CHILD|alice')
+        self.assertEqual(self.loader.load('base.t').generate(current_user='alice'), b'deco:base|meth:base|')
+
+    def test_arguments_of_rendering(self):
+        template = self.loader.load('child.t')
+        self.assertEqual(template.generate(current_user='alice'), b'deco:CHILD|meth:CHILD|alice')
+        self.assertEqual(template.generate(current_user='bob'), b'deco:CHILD|meth:CHILD|bob')
+
+    def test_interleaved_streams(self):
+        template = self.loader.load('child.t')
+        alice = template.generate_stream(current_user='alice')
+        bob = template.generate_stream(current_user='bob')
+        chunks = {'alice': [], 'bob': []}
+        for a, b in zip(alice, bob):
+            chunks['alice'].append(a)
+            chunks['bob'].append(b)
+        chunks['alice'] += list(alice)
+        chunks['bob'] += list(bob)
+        self.assertEqual(b''.join(chunks['alice']), b'deco:CHILD|meth:CHILD|alice')
+        self.assertEqual(b''.join(chunks['bob']), b'deco:CHILD|meth:CHILD|bob')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -183,9 +183,13 @@ __author__ = 'shajunxing'
 __version__ = '2.4.1'
 
 import functools
+import multiprocessing
 import os
+import tempfile
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tore.messaging
 import tore.web
 
@@ -194,6 +198,39 @@ def start_server(**settings):
     Simplest way to start Tornado with just one statement
     """
     port = settings.get('port') or 80
+    messaging_tcp_port = settings.get('messaging_tcp_port')
+    messaging_udp_port = settings.get('messaging_udp_port')
+    processes = settings.get('processes', 1)
+    if processes is None:
+        processes = 1
+    elif processes <= 0:
+        processes = multiprocessing.cpu_count()
+
+    # autoreload of debug mode restarts every process, which binds the ports held by the others again
+    if settings.get('debug') and processes > 1:
+        raise Exception('"debug" requires only one process')
+
+    # messages are logged by the exchange of one process
+    if settings.get('messaging_log_path') and processes > 1:
+        raise Exception('"messaging_log_path" requires only one process')
+
+    # sockets are bound before forking so that all the processes share them
+    http_sockets = tornado.netutil.bind_sockets(port)
+    if messaging_tcp_port:
+        tcp_sockets = tornado.netutil.bind_sockets(messaging_tcp_port)
+    if messaging_udp_port:
+        udp_server = tore.messaging.UDPServer(settings.get('messaging_udp_max_size'),
+            settings.get('messaging_udp_receive_buffer'))
+        udp_server.bind(messaging_udp_port)
+
+    if processes > 1:
+        # socket files of message bus are named by pid of parent process and task id of child process
+        bus_path_format = os.path.join(tempfile.gettempdir(), 'tore-%d-%%d.sock' % os.getpid())
+        task_id = tornado.process.fork_processes(processes)
+        bus = tore.messaging.ProcessBus(bus_path_format, task_id, processes)
+        bus.start()
+
+    # application is created after forking, because debug mode starts autoreload on ioloop
     application = tore.web.Application(**settings)
     if settings.get('encryption'):
         root_dir = settings.get('root_dir')
@@ -201,23 +238,82 @@ def start_server(**settings):
             'certfile': os.path.join(root_dir, settings.get('certfile')),
             'keyfile': os.path.join(root_dir, settings.get('keyfile')),
         })
-        server.listen(port)
     else:
-        application.listen(port)
+        server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(http_sockets)
 
-    messaging_tcp_port = settings.get('messaging_tcp_port')
     if messaging_tcp_port:
-        tcp_server = tore.messaging.TCPServer()
-        tcp_server.listen(messaging_tcp_port)
+        tcp_server = tore.messaging.TCPServer(settings.get('messaging_queue_size'),
+            settings.get('messaging_queue_policy'))
+        tcp_server.add_sockets(tcp_sockets)
 
-    messaging_udp_port = settings.get('messaging_udp_port')
     if messaging_udp_port:
-        udp_server = tore.messaging.UDPServer()
-        udp_server.listen(messaging_udp_port)
+        udp_server.start()
+
+    # retained messages of each destination, delivered to subscribers right after subscribing
+    for destination_regex, count in (settings.get('messaging_retain') or {}).items():
+        tore.messaging.exchange.retain(destination_regex, count)
+    if settings.get('messaging_retain_size'):
+        tore.messaging.exchange.retained_max_size = settings['messaging_retain_size']
+
+    # durable message log, which subscribers can read from an offset
+    if settings.get('messaging_log_path'):
+        tore.messaging.exchange.log = tore.messaging.MessageLog(
+            os.path.join(settings.get('root_dir') or os.getcwd(), settings['messaging_log_path']),
+            settings.get('messaging_log_segment_size'), settings.get('messaging_log_retention_size'),
+            settings.get('messaging_log_retention_age'))
+
+    # messages are delivered on ioloop thread, where the transports live
+    tore.messaging.exchange.bind(tornado.ioloop.IOLoop.instance())
+
+    # federation with other nodes
+    if settings.get('messaging_peers'):
+        federation = tore.messaging.Federation(settings['messaging_peers'])
+        tornado.ioloop.IOLoop.instance().add_callback(federation.start)
 
     # server started callback
     callback = settings.get('callback')
     if callback:
         tornado.ioloop.IOLoop.instance().add_callback(
             functools.partial(callback, port, messaging_tcp_port, messaging_udp_port))
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def precompile(**settings):
+    """
+    compile all the templates into template cache, which is set by "template_cache_path" setting
+    run it at deploy time with the same settings as start_server(), so that server does not compile templates
+    """
+    if not settings.get('template_cache_path'):
+        raise Exception('"template_cache_path" is not set')
+    root_dir = settings.get('root_dir') or os.getcwd()
+    web_root_dir = os.path.join(root_dir, 'web')
+    loader = tore.web.create_loader(web_root_dir, settings)
+    for dirpath, dirnames, filenames in os.walk(web_root_dir):
+        for filename in filenames:
+            if filename.endswith('.t'):
+                name = os.path.relpath(os.path.join(dirpath, filename), web_root_dir).replace(os.sep, '/')
+                loader.load(name)
+
+
+def precompress(**settings):
+    """
+    write compressed copies of static files, such as "jquery.js.gz" and "jquery.js.br" (if brotli is installed),
+    which are sent instead of compressing them when server starts
+    run it at deploy time with the same settings as start_server()
+    """
+    root_dir = settings.get('root_dir') or os.getcwd()
+    web_root_dir = os.path.join(root_dir, 'web')
+    for dirpath, dirnames, filenames in os.walk(web_root_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith('.t') or filename.endswith('.py') or not tore.web.is_compressible(
+                    path, os.path.getsize(path)):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, suffix in tore.web.COMPRESSED_SUFFIXES.items():
+                compressed = tore.web.compress(data, encoding, True)
+                if compressed is not None:
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+"""
+Json codec used by tore.web and tore.messaging
+the fastest installed one of orjson, ujson and json is used, unless another one is selected by "json_codec" setting
+encoded Json is always utf-8 bytes
+"""
+
+import dataclasses
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# supported codecs in order of preference
+CODECS = ('orjson', 'ujson', 'json')
+
+
+def default(obj):
+    """
+    convert objects which are not supported by Json
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        # keep precision
+        return str(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError('%r is not Json serializable' % obj)
+
+
+def _orjson_dumps(obj, pretty=False):
+    option = orjson.OPT_NON_STR_KEYS
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    try:
+        return orjson.dumps(obj, default=default, option=option)
+    except orjson.JSONEncodeError:
+        # orjson does not support integers out of 64-bit range, and some other values json does
+        return _json_dumps(obj, pretty)
+
+
+def _ujson_dumps(obj, pretty=False):
+    return ujson.dumps(obj, ensure_ascii=False, default=default, indent=4 if pretty else 0).encode()
+
+
+def _json_dumps(obj, pretty=False):
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, default=default, indent=4).encode()
+    return json.dumps(obj, ensure_ascii=False, default=default, separators=(',', ':')).encode()
+
+
+def _json_loads(data):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode()
+    return json.loads(data)
+
+
+# name of current codec, and its functions, see select()
+# dumps(obj, pretty=False): encode Python object to utf-8 Json bytes, indented if pretty is True
+# loads(data): decode Json bytes or str to Python object
+name = None
+dumps = None
+loads = None
+
+
+def select(codec=None):
+    """
+    select codec by name, or the fastest installed one if codec is None
+    """
+    global name, dumps, loads
+    if codec is None:
+        codec = 'orjson' if orjson else 'ujson' if ujson else 'json'
+    if codec == 'orjson' and orjson:
+        dumps, loads = _orjson_dumps, orjson.loads
+    elif codec == 'ujson' and ujson:
+        dumps, loads = _ujson_dumps, ujson.loads
+    elif codec == 'json':
+        dumps, loads = _json_dumps, _json_loads
+    elif codec in CODECS:
+        raise Exception('Json codec "%s" is not installed' % codec)
+    else:
+        raise Exception('Unknown Json codec "%s"' % codec)
+    name = codec
+
+
+select()
@@ -1,17 +1,152 @@
 # -*- coding: UTF-8 -*-
 
-import json
+import array
+import atexit
+import collections
+import errno
+import functools
 import logging
+import mmap
+import os
 import queue
 import re
+import signal
 import socket
+import struct
 import threading
+import time
 import tornado.ioloop
+import tornado.iostream
 import tornado.netutil
 import tornado.stack_context
 import tornado.websocket
+import tore.codec
 import uuid
 
+# characters which end the literal part of a regex
+_REGEX_SPECIALS = frozenset('.^$*+?{}[]\\|()')
+
+# quantifiers which allow the preceding character to be absent
+_REGEX_OPTIONAL_QUANTIFIERS = frozenset('*?{')
+
+# maximum count of destinations whose routes are remembered
+_ROUTE_CACHE_SIZE = 4096
+
+# default maximum total bytes of retained messages, see _Exchange.retain()
+DEFAULT_RETAINED_SIZE = 16 * 1024 * 1024
+
+def _has_top_level_alternation(pattern):
+    """
+    check whether a regex contains "|" outside of any group, which makes its literal prefix meaningless
+    """
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+            # "]" right after "[" or "[^" is a literal
+            if pattern[i + 1:i + 2] == '^':
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and not depth:
+            return True
+        i += 1
+    return False
+
+
+def _split_regex(destination_regex, compiled):
+    """
+    split a destination regex into the literal prefix which every matched destination starts with and the rest
+    return (prefix, rest), rest is None if the regex can not be indexed by prefix at all
+    """
+    if compiled.flags & (re.IGNORECASE | re.VERBOSE) or _has_top_level_alternation(destination_regex):
+        return '', None
+    literal = []
+    # re.match() is always anchored at the beginning
+    i = 1 if destination_regex.startswith('^') else 0
+    while i < len(destination_regex):
+        c = destination_regex[i]
+        if c == '\\':
+            escaped = destination_regex[i + 1:i + 2]
+            # "\d", "\A", "\1" ... are not literals
+            if not escaped or escaped.isalnum():
+                break
+            c = escaped
+            step = 2
+        elif c in _REGEX_SPECIALS:
+            break
+        else:
+            step = 1
+        following = destination_regex[i + step:i + step + 1]
+        if following and following in _REGEX_OPTIONAL_QUANTIFIERS:
+            break
+        literal.append(c)
+        i += step
+        if following == '+':
+            break
+    return ''.join(literal), destination_regex[i:]
+
+
+class _PrefixTree():
+    """
+    character trie which maps literal prefixes to destination regexes
+    """
+
+    def __init__(self):
+        # every node is a dict keyed by the next character, key None holds the destination regexes ending here
+        self.__root = dict()
+
+    def add(self, prefix, destination_regex):
+        node = self.__root
+        for c in prefix:
+            node = node.setdefault(c, dict())
+        node.setdefault(None, set()).add(destination_regex)
+
+    def remove(self, prefix, destination_regex):
+        path = list()
+        node = self.__root
+        for c in prefix:
+            path.append((node, c))
+            node = node[c]
+        node[None].discard(destination_regex)
+        if not node[None]:
+            del node[None]
+        # empty nodes are removed to save memory
+        while path and not node:
+            parent, c = path.pop()
+            del parent[c]
+            node = parent
+
+    def walk(self, destination):
+        """
+        yield all the destination regexes whose prefix the destination starts with
+        """
+        node = self.__root
+        if None in node:
+            for destination_regex in node[None]:
+                yield destination_regex
+        for c in destination:
+            node = node.get(c)
+            if node is None:
+                return
+            if None in node:
+                for destination_regex in node[None]:
+                    yield destination_regex
+
+
 class _Exchange():
     """
     The message exchanger, contains core algorithm of pub/sub messaging model
@@ -23,98 +158,473 @@ class _Exchange():
         # {
         #     <destination regex>: {
         #         'compiled': <compiled regular expression>,
+        #         'prefix': <literal prefix of destination regex>,
+        #         'kind': <'exact', 'literal' or 'regex', see __index()>,
         #         'callbacks': {
-        #             uuid: <callback function>,
+        #             uuid: (<callback function>, <whether callback receives a _MessageFrame>,
+        #                    <whether callback is of a federation link>),
         #             ...
-        #         }
+        #         },
+        #         'local': <count of callbacks which are not of federation links>
         #     };
         #     ...
         # }
         self.__receivers = dict()
-        self.__receivers_lock = threading.Lock()
+        # reverse map of uuid -> destination regex
+        self.__receiver_ids = dict()
+        # routing index, exact destinations are hashed and the others are looked up by literal prefix
+        self.__exact_index = dict()
+        self.__prefix_index = _PrefixTree()
+        # recent destination -> [(destination regex, match result), ...] lookups
+        self.__route_cache = collections.OrderedDict()
+        # reentrant, because retained messages are delivered to callbacks while adding them, see __replay()
+        self.__receivers_lock = threading.RLock()
+        # destination regex -> (compiled regular expression, count of retained messages), see retain()
+        self.__retentions = dict()
+        # recent destination -> count of retained messages lookups
+        self.__retention_cache = collections.OrderedDict()
+        # destination -> deque of retained messages as RawContent, least recently pushed destination first
+        self.__retained = collections.OrderedDict()
+        self.__retained_size = 0
+        # least recently pushed destinations are evicted when total bytes of retained messages exceed it
+        self.retained_max_size = DEFAULT_RETAINED_SIZE
+        # before bind() is called, messages are delivered by a consumer thread which is started on first push
         self.__message_queue = queue.Queue()
-        consumer_thread = threading.Thread(target=self.__push_consumer)
-        consumer_thread.daemon = True
-        consumer_thread.start()
+        self.__consumer_thread = None
+        # after bind() is called, messages are delivered on IOLoop thread
+        # messages pushed from other threads are collected into pending list and handed over in batches
+        self.__io_loop = None
+        self.__io_loop_thread = None
+        self.__pending = list()
+        self.__pending_lock = threading.Lock()
+        self.__drain_scheduled = False
+        # objects which forward delivered messages out of this process, see add_forwarder()
+        self.__forwarders = list()
+        # functions called when local interests change, see add_interest_listener()
+        self.__interest_listeners = list()
+        # if it is set to a MessageLog, every delivered message is appended to it and gets an offset
+        self.log = None
+
+    def bind(self, io_loop):
+        """
+        deliver all the messages on the IOLoop thread from now on
+        receivers are then only changed and read on that thread, so transports can write to their streams safely
+        """
+        self.__io_loop = io_loop
+        io_loop.add_callback(self.__on_io_loop_started)
+
+    def __on_io_loop_started(self):
+        self.__io_loop_thread = threading.current_thread()
+
+    def __in_io_loop(self):
+        """
+        whether current thread is the IOLoop thread of a bound exchange
+        """
+        return self.__io_loop_thread is threading.current_thread()
+
+    def __locked(self, function, *args):
+        with self.__receivers_lock:
+            function(*args)
+
+    def __change(self, function, *args):
+        """
+        change receivers, on the IOLoop thread if bound
+        """
+        if self.__io_loop is not None and not self.__in_io_loop():
+            self.__io_loop.add_callback(functools.partial(self.__locked, function, *args))
+        else:
+            self.__locked(function, *args)
 
+    def __index(self, destination_regex, receiver):
+        """
+        put a new destination regex into routing index
+        "exact" regexes are literal strings followed by "$" and never need to be run
+        "literal" regexes are literal strings which match every destination starting with them
+        "regex" regexes are run against destinations starting with their literal prefix
+        """
+        prefix, rest = _split_regex(destination_regex, receiver['compiled'])
+        receiver['prefix'] = prefix
+        if rest == '$' and not receiver['compiled'].flags & re.MULTILINE:
+            receiver['kind'] = 'exact'
+            self.__exact_index.setdefault(prefix, set()).add(destination_regex)
+        else:
+            receiver['kind'] = 'literal' if rest == '' else 'regex'
+            self.__prefix_index.add(prefix, destination_regex)
+        self.__route_cache.clear()
+
+    def __unindex(self, destination_regex, receiver):
+        """
+        remove a destination regex from routing index
+        """
+        prefix = receiver['prefix']
+        if receiver['kind'] == 'exact':
+            regexes = self.__exact_index[prefix]
+            regexes.discard(destination_regex)
+            if not regexes:
+                del self.__exact_index[prefix]
+        else:
+            self.__prefix_index.remove(prefix, destination_regex)
+        self.__route_cache.clear()
+
+    def __route(self, destination):
+        """
+        find all the destination regexes matched by destination
+        return a list of (destination regex, match result)
+        """
+        routes = self.__route_cache.get(destination)
+        if routes is not None:
+            self.__route_cache.move_to_end(destination)
+            return routes
+        routes = list()
+        for destination_regex in self.__exact_index.get(destination, ()):
+            routes.append((destination_regex, [destination]))
+        # "$" also matches before a trailing newline
+        if destination.endswith('\n'):
+            for destination_regex in self.__exact_index.get(destination[:-1], ()):
+                routes.append((destination_regex, [destination]))
+        for destination_regex in self.__prefix_index.walk(destination):
+            receiver = self.__receivers[destination_regex]
+            if receiver['kind'] == 'literal':
+                routes.append((destination_regex, [destination]))
+                continue
+            m = receiver['compiled'].match(destination)
+            if m:
+                match_result = [destination]
+                match_result += m.groups()
+                routes.append((destination_regex, match_result))
+        self.__route_cache[destination] = routes
+        if len(self.__route_cache) > _ROUTE_CACHE_SIZE:
+            self.__route_cache.popitem(last=False)
+        return routes
 
-    def add(self, destination_regex, callback):
+    def add(self, destination_regex, callback, framed=False, retained=True, federation=False):
         """
         add a destination regex and corresponding callback
         all the messages matched destination will trigger the callback
+        callback is called as callback(content, match), or callback(frame) if framed is True,
+        where frame is a _MessageFrame shared by all the framed callbacks of the same destination regex
+        if retained is True, retained messages matched destination regex are delivered to callback at once, see retain()
+        if federation is True, callback is of a federation link, which does not receive messages from other nodes,
+        and is not a local interest, see Federation
         return an identification for callback removal
         """
         id = str(uuid.uuid1())
-        self.__receivers_lock.acquire()
+        # compiled here so that invalid regex is raised to caller
+        compiled = re.compile(destination_regex)
+        self.__change(self.__add, id, destination_regex, compiled, callback, framed, retained, federation)
+        return id
+
+    def __add(self, id, destination_regex, compiled, callback, framed, retained, federation):
         if destination_regex in self.__receivers:
-            callbacks = self.__receivers[destination_regex]['callbacks']
-            callbacks[id] = callback
+            receiver = self.__receivers[destination_regex]
+            receiver['callbacks'][id] = (callback, framed, federation)
         else:
-            compiled = re.compile(destination_regex)
-            self.__receivers[destination_regex] = {
+            receiver = {
                 'compiled': compiled,
                 'callbacks': {
-                    id: callback
-                }
+                    id: (callback, framed, federation)
+                },
+                'local': 0
             }
-        self.__receivers_lock.release()
-        return id
+            self.__index(destination_regex, receiver)
+            self.__receivers[destination_regex] = receiver
+        self.__receiver_ids[id] = destination_regex
+        if not federation:
+            receiver['local'] += 1
+            if receiver['local'] == 1:
+                self.__notify_interest(destination_regex, True)
+        if retained:
+            self.__replay(receiver, callback, framed)
+
+    def __remove(self, id):
+        """
+        remove a callback
+        """
+        destination_regex = self.__receiver_ids.pop(id, None)
+        if destination_regex is None:
+            return
+        receiver = self.__receivers[destination_regex]
+        callbacks = receiver['callbacks']
+        callback, framed, federation = callbacks.pop(id)
+        if not federation:
+            receiver['local'] -= 1
+            if receiver['local'] == 0:
+                self.__notify_interest(destination_regex, False)
+        # if no callbacks in one destination regex, it will be removed to save memory
+        if not callbacks:
+            self.__unindex(destination_regex, self.__receivers.pop(destination_regex))
 
     def remove(self, id):
         """
         remove a callback by it's identification
         """
-        # if no callbacks in one destination regex, it will be removed to save memory
-        # removeList is a list for removal
-        removeList = list()
-        self.__receivers_lock.acquire()
-        for destination_regex in self.__receivers:
-            callbacks = self.__receivers[destination_regex]['callbacks']
-            if id in callbacks:
-                del callbacks[id]
-            if not len(callbacks):
-                removeList.append(destination_regex)
-        for destination_regex in removeList:
-            del self.__receivers[destination_regex]
-        self.__receivers_lock.release()
+        self.__change(self.__remove, id)
 
-    def push(self, message, destination):
+    def remove_many(self, ids):
         """
-        push a message to queue
+        remove callbacks by their identifications at once, used when a connection closes
         """
-        item = {
-            'message': message,
-            'destination': destination
-        }
-        #        logging.debug('pushing: %s', item)
-        self.__message_queue.put(item)
+        self.__change(self.__remove_many, list(ids))
+
+    def __remove_many(self, ids):
+        for id in ids:
+            self.__remove(id)
+
+    def retain(self, destination_regex, count=1):
+        """
+        keep the last count messages of each destination matched destination regex, count 0 means not to keep
+        if a destination matches several destination regexes, the largest count is used
+        retained messages are delivered to callbacks right after they are added, so that subscribers do not have to
+        wait for next message, total bytes of them are limited by retained_max_size
+        NOTICE: call it before messages are pushed, all the retained messages are dropped when it is called
+        """
+        compiled = re.compile(destination_regex)
+        self.__change(self.__retain, destination_regex, compiled, count)
+
+    def __retain(self, destination_regex, compiled, count):
+        if count > 0:
+            self.__retentions[destination_regex] = (compiled, count)
+        else:
+            self.__retentions.pop(destination_regex, None)
+        self.__retention_cache.clear()
+        self.__clear_retained()
+
+    def clear_retained(self):
+        """
+        drop all the retained messages
+        """
+        self.__change(self.__clear_retained)
+
+    def __clear_retained(self):
+        self.__retained.clear()
+        self.__retained_size = 0
+
+    def __retention(self, destination):
+        """
+        count of retained messages of destination
+        """
+        count = self.__retention_cache.get(destination)
+        if count is not None:
+            return count
+        count = 0
+        for compiled, n in self.__retentions.values():
+            if n > count and compiled.match(destination):
+                count = n
+        self.__retention_cache[destination] = count
+        if len(self.__retention_cache) > _ROUTE_CACHE_SIZE:
+            self.__retention_cache.popitem(last=False)
+        return count
+
+    def __store(self, message, destination):
+        """
+        keep message as retained message of destination if required
+        """
+        count = self.__retention(destination)
+        if not count:
+            return
+        if not isinstance(message, RawContent):
+            # encoded once, then it is spliced into frames when delivered, and its size is known
+            message = RawContent(tore.codec.dumps(message))
+        messages = self.__retained.get(destination)
+        if messages is None:
+            messages = collections.deque(maxlen=count)
+            self.__retained[destination] = messages
+        else:
+            self.__retained.move_to_end(destination)
+            if len(messages) == count:
+                self.__retained_size -= len(messages[0].data)
+        messages.append(message)
+        self.__retained_size += len(message.data)
+        while self.__retained_size > self.retained_max_size and self.__retained:
+            evicted = self.__retained.popitem(last=False)[1]
+            self.__retained_size -= sum(len(m.data) for m in evicted)
+            counters['retained_evicted'] += len(evicted)
+
+    def __replay(self, receiver, callback, framed):
+        """
+        deliver retained messages matched destination regex of receiver to a newly added callback
+        """
+        if not self.__retained:
+            return
+        prefix = receiver['prefix']
+        if receiver['kind'] == 'exact':
+            # "$" also matches before a trailing newline
+            destinations = [d for d in (prefix, prefix + '\n') if d in self.__retained]
+        else:
+            destinations = [d for d in self.__retained if d.startswith(prefix)]
+        for destination in destinations:
+            m = receiver['compiled'].match(destination)
+            if not m:
+                continue
+            match_result = [destination]
+            match_result += m.groups()
+            # copied, because callback may push messages which change retained messages
+            for message in list(self.__retained.get(destination, ())):
+                try:
+                    if framed:
+                        callback(_MessageFrame(message, match_result))
+                    else:
+                        callback(message.value, match_result)
+                except Exception as ex:
+                    logging.warning(ex)
+
+    def add_forwarder(self, forwarder):
+        """
+        add an object whose forward(message, destination, origin) method is called after each message is delivered
+        origin is the object passed to push(), so that forwarder will not send a message back to where it comes from
+        """
+        self.__forwarders.append(forwarder)
+
+    def remove_forwarder(self, forwarder):
+        self.__forwarders.remove(forwarder)
+
+    def add_interest_listener(self, listener):
+        """
+        add a function which is called as listener(destination_regex, interested) when the first local callback
+        of destination regex is added (interested is True), or the last one is removed (interested is False)
+        NOTICE: listener is called with receivers locked, on any thread which changes receivers
+        """
+        self.__interest_listeners.append(listener)
+
+    def remove_interest_listener(self, listener):
+        self.__interest_listeners.remove(listener)
+
+    def __notify_interest(self, destination_regex, interested):
+        for listener in self.__interest_listeners:
+            try:
+                listener(destination_regex, interested)
+            except Exception as ex:
+                logging.warning(ex)
+
+    def interests(self):
+        """
+        destination regexes which have local callbacks
+        """
+        with self.__receivers_lock:
+            return [destination_regex for destination_regex, receiver in self.__receivers.items() if receiver['local']]
+
+    def push(self, message, destination, origin=None):
+        """
+        push a message
+        origin is None for local messages, or the forwarder which message comes from
+        if bound, messages pushed on the IOLoop thread are delivered immediately,
+        or they are handed over to the IOLoop thread in batches
+        """
+        if self.__io_loop is None:
+            item = {
+                'message': message,
+                'destination': destination,
+                'origin': origin
+            }
+            #        logging.debug('pushing: %s', item)
+            self.__message_queue.put(item)
+            if self.__consumer_thread is None:
+                self.__start_consumer()
+        elif self.__in_io_loop():
+            self.__deliver(message, destination, origin)
+        else:
+            with self.__pending_lock:
+                self.__pending.append((message, destination, origin))
+                if self.__drain_scheduled:
+                    return
+                self.__drain_scheduled = True
+            # only one IOLoop callback for all the messages pushed before it runs
+            self.__io_loop.add_callback(self.__drain)
+
+    def push_many(self, messages, origin=None):
+        """
+        push many messages at once
+        messages: iterable of (message, destination)
+        """
+        if self.__io_loop is None:
+            for message, destination in messages:
+                self.push(message, destination, origin)
+        elif self.__in_io_loop():
+            for message, destination in messages:
+                self.__deliver(message, destination, origin)
+        else:
+            with self.__pending_lock:
+                self.__pending.extend((message, destination, origin) for message, destination in messages)
+                if self.__drain_scheduled:
+                    return
+                self.__drain_scheduled = True
+            self.__io_loop.add_callback(self.__drain)
+
+    def __drain(self):
+        """
+        deliver pending messages on IOLoop thread
+        """
+        with self.__pending_lock:
+            pending = self.__pending
+            self.__pending = list()
+            self.__drain_scheduled = False
+        for message, destination, origin in pending:
+            self.__deliver(message, destination, origin)
+
+    def __deliver(self, message, destination, origin=None):
+        """
+        trigger all the destination matched callbacks, then forward message
+        """
+        # content of frames
+        framed_message = message
+        offset = None
+        if self.log is not None:
+            if not isinstance(message, RawContent):
+                # encoded once for message log and frames
+                framed_message = RawContent(tore.codec.dumps(message))
+            offset = self.log.append(framed_message.data, destination)
+        if self.__retentions:
+            self.__store(framed_message, destination)
+        # messages from other nodes are not sent to other nodes again
+        federated = isinstance(origin, _FederationLink)
+        # callbacks of federation links which message is sent to, a link whose destination regexes overlap receives
+        # message only once
+        linked = None
+        for destination_regex, match_result in self.__route(destination):
+            callbacks = self.__receivers[destination_regex]['callbacks']
+            # frame is built once and encoded at most once for all the subscribers of this regex
+            frame = None
+            for callback, framed, federation in callbacks.values():
+                if federation:
+                    if federated or (linked is not None and callback in linked):
+                        continue
+                    if linked is None:
+                        linked = set()
+                    linked.add(callback)
+                # May raise exception "AttributeError: 'NoneType' object has no attribute 'write_message'" sometimes after WebSocket closed
+                try:
+                    if framed:
+                        if frame is None:
+                            frame = _MessageFrame(framed_message, match_result, offset)
+                        callback(frame)
+                    elif isinstance(message, RawContent):
+                        callback(message.value, match_result)
+                    else:
+                        callback(message, match_result)
+                except Exception as ex:
+                    logging.warning(ex)
+        for forwarder in self.__forwarders:
+            try:
+                forwarder.forward(message, destination, origin)
+            except Exception as ex:
+                logging.warning(ex)
+
+    def __start_consumer(self):
+        with self.__receivers_lock:
+            if self.__consumer_thread is None:
+                self.__consumer_thread = threading.Thread(target=self.__push_consumer)
+                self.__consumer_thread.daemon = True
+                self.__consumer_thread.start()
 
     def __push_consumer(self):
         """
-        message queue consumer thread
-        all the destination matched callbacks will be triggered
+        message queue consumer thread, used before bind() is called
         """
         while True:
             item = self.__message_queue.get()
             #            logging.debug('consuming: %s', item)
-            message = item['message']
-            destination = item['destination']
-            self.__receivers_lock.acquire()
-            for destination_regex in self.__receivers:
-                compiled_regex = self.__receivers[destination_regex]['compiled']
-                m = compiled_regex.match(destination)
-                if not m:
-                    continue
-                match_result = [destination]
-                match_result += m.groups()
-                callbacks = self.__receivers[destination_regex]['callbacks']
-                for id in callbacks:
-                    # May raise exception "AttributeError: 'NoneType' object has no attribute 'write_message'" sometimes after WebSocket closed
-                    try:
-                        callbacks[id](message, match_result)
-                    except Exception as ex:
-                        logging.warning(ex)
-            self.__receivers_lock.release()
+            with self.__receivers_lock:
+                self.__deliver(item['message'], item['destination'], item['origin'])
             self.__message_queue.task_done()
 
     def print_receivers(self):
@@ -126,64 +636,830 @@ class _Exchange():
             print('"%s" {' % destination_regex)
             callbacks = self.__receivers[destination_regex]['callbacks']
             for id in callbacks:
-                print('    "%s": %s' % (id, callbacks[id]))
+                print('    "%s": %s' % (id, callbacks[id][0]))
             print('}')
         self.__receivers_lock.release()
         print()
 
+
+class _MessageFrame():
+    """
+    message frame delivered to framed callbacks
+    text and bytes are encoded on first use and then shared by all the subscribers
+    """
+
+    def __init__(self, content, match, offset=None):
+        self.content = content
+        self.match = match
+        # offset in message log, None if it is not enabled
+        self.offset = offset
+        self.__text = None
+        self.__encoded = None
+        self.__data = None
+        self.__binary = None
+
+    @property
+    def text(self):
+        """
+        Json text of message frame
+        """
+        if self.__text is None:
+            self.__text = self.encoded.decode()
+        return self.__text
+
+    @property
+    def encoded(self):
+        """
+        utf-8 encoded message frame, used by WebSocket
+        """
+        if self.__encoded is None:
+            self.__encoded = message_frame(self.content, self.match, self.offset)
+        return self.__encoded
+
+    @property
+    def data(self):
+        """
+        utf-8 encoded message frame with tailed '\\0', used by TCP
+        """
+        if self.__data is None:
+            self.__data = self.encoded + b'\0'
+        return self.__data
+
+    @property
+    def binary(self):
+        """
+        length prefixed binary message frame, used by TCP connections in binary framing
+        """
+        if self.__binary is None:
+            self.__binary = binary_message_frame(_content_bytes(self.content), self.match, self.offset)
+        return self.__binary
+
+
+class RawContent():
+    """
+    message content which is already Json encoded, such as the payload of a binary publish frame
+    it is passed through to subscribers without being parsed, and is only decoded if a plain callback needs it
+    """
+
+    def __init__(self, data):
+        """
+        data: utf-8 encoded Json
+        """
+        self.data = data
+        self.__text = None
+        self.__value = None
+        self.__parsed = False
+
+    @property
+    def text(self):
+        if self.__text is None:
+            self.__text = self.data.decode()
+        return self.__text
+
+    @property
+    def value(self):
+        """
+        decoded Python object
+        """
+        if not self.__parsed:
+            self.__value = tore.codec.loads(self.data)
+            self.__parsed = True
+        return self.__value
+
 # global message exchange
 exchange = _Exchange()
 
-def message_frame(content, match):
+# identification of this node, which is shared by the processes forked by tore.start_server(), see Federation
+node_id = str(uuid.uuid4())
+
+# global counters of messaging service, for monitoring purpose
+# outbound_dropped: messages dropped or conflated by outbound queues of slow subscribers
+# outbound_disconnected: slow subscribers disconnected by outbound queues
+# bus_dropped: messages which cannot be sent to another process
+# bus_errors: messages from another process which cannot be parsed
+# udp_received: received UDP datagrams
+# udp_truncated: UDP datagrams larger than maximum size
+# udp_parse_errors: UDP datagrams which cannot be parsed
+# udp_dropped: UDP datagrams which are truncated or cannot be parsed
+# retained_evicted: retained messages evicted because of memory limit
+# federation_received: messages received from other nodes
+counters = collections.Counter()
+
+def _dumps_with_content(obj, content):
+    """
+    convert frame dictionary to utf-8 encoded Json with "content" as the last key
+    RawContent is spliced without being parsed
+    """
+    if isinstance(content, RawContent):
+        return tore.codec.dumps(obj)[:-1] + b',"content":' + content.data + b'}'
+    obj['content'] = content
+    return tore.codec.dumps(obj)
+
+
+def _content_bytes(content):
+    """
+    utf-8 encoded Json of content, used as binary frame payload
+    """
+    if isinstance(content, RawContent):
+        return content.data
+    return tore.codec.dumps(content)
+
+
+# Json frames
+#
+# Every frame is utf-8 encoded Json bytes encoded by tore.codec, which is terminated by '\0' on TCP connections.
+
+
+def message_frame(content, match, offset=None):
     """
     message frame
+    offset is the offset of message in message log, see MessageLog
     """
-    return json.dumps({
+    obj = {
         'type': 'message',
-        'match': match,
-        'content': content
-    }, ensure_ascii=False)
+        'match': match
+    }
+    if offset is not None:
+        obj['offset'] = offset
+    return _dumps_with_content(obj, content)
 
 
 def error_frame(content):
     """
     error frame
     """
-    return json.dumps({
+    return tore.codec.dumps({
         'type': 'error',
         'content': content
-    }, ensure_ascii=False)
+    })
 
 
 def publish_frame(content, destination):
     """
     message publish frame
     """
-    return json.dumps({
+    return _dumps_with_content({
         'type': 'publish',
-        'destination': destination,
-        'content': content
-    }, ensure_ascii=False)
+        'destination': destination
+    }, content)
 
 
-def subscribe_frame(destination):
+def publish_batch_frame(messages):
+    """
+    publish frame of many messages
+    messages: iterable of (content, destination)
+    """
+    return _BATCH_PREFIX + b','.join(
+        [publish_frame(content, destination) for content, destination in messages]) + _BATCH_SUFFIX
+
+
+def subscribe_frame(destination, from_offset=None):
     """
     message subscribe frame
+    if from_offset is not None, messages are sent from that offset of message log first, see MessageLog
     """
-    return json.dumps({
+    obj = {
         'type': 'subscribe',
         'destination': destination
-    }, ensure_ascii=False)
+    }
+    if from_offset is not None:
+        obj['from_offset'] = from_offset
+    return tore.codec.dumps(obj)
 
 
 def unsubscribe_frame(destination):
     """
     message unsubscribe frame
     """
-    return json.dumps({
+    return tore.codec.dumps({
         'type': 'unsubscribe',
         'destination': destination
-    }, ensure_ascii=False)
+    })
+
+
+def framing_frame(framing):
+    """
+    framing negotiation frame, sent by TCP client as its first frame to switch the connection to another framing
+    currently only "binary" is supported
+    """
+    return tore.codec.dumps({
+        'type': 'framing',
+        'framing': framing
+    })
+
+
+def link_frame(node):
+    """
+    federation link frame, sent by another node as its first frame, then the connection is in binary framing
+    """
+    return tore.codec.dumps({
+        'type': 'link',
+        'node': node
+    })
+
+# Binary framing of TCP connections
+#
+# Every frame is a 4 bytes big endian body length followed by the body. The first byte of body is frame type.
+#
+# publish:     type, 2 bytes destination length, utf-8 destination, payload
+# subscribe:   type, utf-8 destination
+# unsubscribe: type, utf-8 destination
+# message:     type, 1 byte match count, (2 bytes length, utf-8 string) of each match, payload
+#              unmatched group is written as length 0xffff without string
+# error:       type, utf-8 error description
+# publish_batch: type, then (2 bytes destination length, utf-8 destination, 4 bytes payload length, payload)
+#              of each message
+# logged_message: type, 8 bytes offset, then same as message, sent instead of message if message log is enabled
+# subscribe_from: type, 8 bytes offset, utf-8 destination
+#
+# Payload is opaque to server, it is treated as utf-8 encoded Json when delivered to Json framing subscribers.
+
+BINARY_TYPES = ('publish', 'subscribe', 'unsubscribe', 'message', 'error', 'publish_batch', 'logged_message',
+    'subscribe_from')
+
+# maximum body length of a binary frame
+BINARY_MAX_LENGTH = 16 * 1024 * 1024
+
+_BINARY_CODES = dict((type, code) for code, type in enumerate(BINARY_TYPES, 1))
+
+_NONE_LENGTH = 0xffff
+
+def _binary_frame(type, *parts):
+    length = 1 + sum(len(part) for part in parts)
+    return b''.join((struct.pack('!IB', length, _BINARY_CODES[type]),) + parts)
+
+
+def _binary_string(s):
+    if s is None:
+        return struct.pack('!H', _NONE_LENGTH)
+    encoded = s.encode()
+    return struct.pack('!H', len(encoded)) + encoded
+
+
+def binary_message_frame(payload, match, offset=None):
+    """
+    binary message frame, or logged_message frame if offset is not None
+    """
+    parts = [struct.pack('!B', len(match))] + [_binary_string(s) for s in match] + [payload]
+    if offset is None:
+        return _binary_frame('message', *parts)
+    return _binary_frame('logged_message', struct.pack('!Q', offset), *parts)
+
+
+def binary_error_frame(content):
+    """
+    binary error frame
+    """
+    return _binary_frame('error', content.encode())
+
+
+def binary_publish_frame(payload, destination):
+    """
+    binary message publish frame, payload is utf-8 encoded Json bytes
+    """
+    return _binary_frame('publish', _binary_string(destination), payload)
+
+
+def binary_publish_batch_frame(messages):
+    """
+    binary publish frame of many messages
+    messages: iterable of (payload, destination)
+    """
+    parts = list()
+    for payload, destination in messages:
+        parts.append(_binary_string(destination))
+        parts.append(struct.pack('!I', len(payload)))
+        parts.append(payload)
+    return _binary_frame('publish_batch', *parts)
+
+
+def binary_subscribe_frame(destination, from_offset=None):
+    """
+    binary message subscribe frame, or subscribe_from frame if from_offset is not None
+    """
+    if from_offset is None:
+        return _binary_frame('subscribe', destination.encode())
+    return _binary_frame('subscribe_from', struct.pack('!Q', from_offset), destination.encode())
+
+
+def binary_unsubscribe_frame(destination):
+    """
+    binary message unsubscribe frame
+    """
+    return _binary_frame('unsubscribe', destination.encode())
+
+
+def parse_binary_frame(body):
+    """
+    parse binary frame body (without length prefix) to dictionary like parsed Json frame
+    payload is returned as RawContent
+    """
+    if not 1 <= body[0] <= len(BINARY_TYPES):
+        raise Exception('Unknown binary frame type %d' % body[0])
+    type = BINARY_TYPES[body[0] - 1]
+    if type == 'publish':
+        length, = struct.unpack_from('!H', body, 1)
+        return {
+            'type': type,
+            'destination': body[3:3 + length].decode(),
+            'content': RawContent(body[3 + length:])
+        }
+    elif type == 'message':
+        return _parse_binary_message(body, 1)
+    elif type == 'logged_message':
+        parsed = _parse_binary_message(body, 9)
+        parsed['offset'], = struct.unpack_from('!Q', body, 1)
+        return parsed
+    elif type == 'subscribe_from':
+        from_offset, = struct.unpack_from('!Q', body, 1)
+        return {
+            'type': 'subscribe',
+            'destination': body[9:].decode(),
+            'from_offset': from_offset
+        }
+    elif type == 'error':
+        return {
+            'type': type,
+            'content': body[1:].decode()
+        }
+    elif type == 'publish_batch':
+        messages = list()
+        offset = 1
+        while offset < len(body):
+            length, = struct.unpack_from('!H', body, offset)
+            offset += 2
+            destination = body[offset:offset + length].decode()
+            offset += length
+            length, = struct.unpack_from('!I', body, offset)
+            offset += 4
+            messages.append({
+                'destination': destination,
+                'content': RawContent(body[offset:offset + length])
+            })
+            offset += length
+        return {
+            'type': type,
+            'messages': messages
+        }
+    else:
+        return {
+            'type': type,
+            'destination': body[1:].decode()
+        }
+
+
+def _parse_binary_message(body, start):
+    """
+    parse match and payload of binary message frame, which start at start
+    """
+    match = list()
+    offset = start + 1
+    for i in range(body[start]):
+        length, = struct.unpack_from('!H', body, offset)
+        offset += 2
+        if length == _NONE_LENGTH:
+            match.append(None)
+        else:
+            match.append(body[offset:offset + length].decode())
+            offset += length
+    return {
+        'type': 'message',
+        'match': match,
+        'content': RawContent(body[offset:])
+    }
+
+
+# Durable message log
+#
+# Messages are appended to segment files of a directory, each named by the offset of its first message, such as
+# "00000000000000000000.log". Segment files are preallocated to segment size and memory-mapped, so that records are
+# written and read without system calls. Every record is:
+#
+# 4 bytes length of following bytes, 8 bytes offset, 8 bytes timestamp (double), 2 bytes destination length,
+# utf-8 destination, payload (utf-8 encoded Json)
+#
+# Length is written after the others, and zero length marks the end of segment, so that a record partially written
+# when process crashes is ignored.
+
+# default maximum bytes of a segment file
+DEFAULT_LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+
+_RECORD_HEADER = struct.Struct('!IQdH')
+
+_LOG_SUFFIX = '.log'
+
+
+class _Segment():
+    """
+    memory-mapped segment file of message log
+    """
+
+    def __init__(self, path, base_offset, size=None):
+        """
+        open an existing segment file if size is None, or create a new one of size bytes
+        """
+        self.path = path
+        self.base_offset = base_offset
+        if size is None:
+            self.__file = open(path, 'r+b')
+            self.last_time = os.path.getmtime(path)
+        else:
+            self.__file = open(path, 'w+b')
+            self.__file.truncate(size)
+            self.last_time = time.time()
+        self.size = os.fstat(self.__file.fileno()).st_size
+        self.__mmap = mmap.mmap(self.__file.fileno(), self.size)
+        # position of each record
+        self.positions = array.array('L')
+        # position after the last record
+        self.end = 0
+        self.__scan()
+
+    def __scan(self):
+        """
+        find all the records
+        """
+        while self.end + _RECORD_HEADER.size <= self.size:
+            length, offset, timestamp, destination_length = _RECORD_HEADER.unpack_from(self.__mmap, self.end)
+            if length == 0 or self.end + 4 + length > self.size or offset != self.next_offset:
+                break
+            self.positions.append(self.end)
+            self.last_time = timestamp
+            self.end += 4 + length
+
+    @property
+    def next_offset(self):
+        return self.base_offset + len(self.positions)
+
+    def append(self, timestamp, destination, payload):
+        """
+        append a record, destination is utf-8 encoded, return False if segment is full
+        """
+        length = _RECORD_HEADER.size - 4 + len(destination) + len(payload)
+        position = self.end
+        end = position + 4 + length
+        if end > self.size:
+            return False
+        _RECORD_HEADER.pack_into(self.__mmap, position, 0, self.next_offset, timestamp, len(destination))
+        start = position + _RECORD_HEADER.size
+        self.__mmap[start:start + len(destination)] = destination
+        self.__mmap[start + len(destination):end] = payload
+        # end mark, in case there is a partially written record after it
+        if end + 4 <= self.size:
+            self.__mmap[end:end + 4] = b'\0\0\0\0'
+        struct.pack_into('!I', self.__mmap, position, length)
+        self.positions.append(position)
+        self.end = end
+        self.last_time = timestamp
+        return True
+
+    def read(self, index):
+        """
+        return (offset, destination, payload) of record at index, payload is copied from memory map without parsing
+        """
+        position = self.positions[index]
+        length, offset, timestamp, destination_length = _RECORD_HEADER.unpack_from(self.__mmap, position)
+        start = position + _RECORD_HEADER.size
+        return (offset, self.__mmap[start:start + destination_length].decode(),
+            self.__mmap[start + destination_length:position + 4 + length])
+
+    def flush(self):
+        self.__mmap.flush()
+
+    def close(self):
+        self.__mmap.close()
+        self.__file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class MessageLog():
+    """
+    durable append-only log of messages, every message gets an offset which is 1 larger than previous one
+    a new segment file is created when current one is full, then oldest segments are deleted if total bytes of records
+    exceed retention_size, or their last message is older than retention_age seconds
+    appended messages survive crash of process, call flush() to write them to disk
+    """
+
+    def __init__(self, path, segment_size=None, retention_size=None, retention_age=None):
+        self.__path = path
+        self.__segment_size = segment_size or DEFAULT_LOG_SEGMENT_SIZE
+        self.__retention_size = retention_size
+        self.__retention_age = retention_age
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.__segments = list()
+        for name in sorted(os.listdir(path)):
+            if name.endswith(_LOG_SUFFIX):
+                self.__segments.append(_Segment(os.path.join(path, name), int(name[:-len(_LOG_SUFFIX)])))
+        if not self.__segments:
+            self.__segments.append(self.__create(0, self.__segment_size))
+        atexit.register(self.close)
+
+    def __create(self, base_offset, size):
+        return _Segment(os.path.join(self.__path, '%020d%s' % (base_offset, _LOG_SUFFIX)), base_offset, size)
+
+    @property
+    def first_offset(self):
+        """
+        offset of the oldest message
+        """
+        return self.__segments[0].base_offset
+
+    @property
+    def next_offset(self):
+        """
+        offset of next appended message
+        """
+        return self.__segments[-1].next_offset
+
+    def append(self, payload, destination):
+        """
+        append a message, payload is utf-8 encoded Json, return its offset
+        """
+        segment = self.__segments[-1]
+        offset = segment.next_offset
+        timestamp = time.time()
+        destination = destination.encode()
+        if not segment.append(timestamp, destination, payload):
+            segment.flush()
+            # a message larger than segment size is written into a segment of its own
+            length = _RECORD_HEADER.size + len(destination) + len(payload) + 4
+            segment = self.__create(offset, max(self.__segment_size, length))
+            self.__segments.append(segment)
+            segment.append(timestamp, destination, payload)
+            self.__retain(timestamp)
+        elif self.__retention_age is not None and len(self.__segments) > 1 and \
+                self.__segments[0].last_time < timestamp - self.__retention_age:
+            self.__retain(timestamp)
+        return offset
+
+    def __retain(self, now):
+        """
+        delete oldest segments by retention size and age, current segment is never deleted
+        """
+        size = sum(segment.end for segment in self.__segments)
+        while len(self.__segments) > 1:
+            oldest = self.__segments[0]
+            if self.__retention_age is not None and oldest.last_time < now - self.__retention_age:
+                pass
+            elif self.__retention_size is not None and size > self.__retention_size:
+                pass
+            else:
+                break
+            del self.__segments[0]
+            size -= oldest.end
+            oldest.delete()
+
+    def read(self, offset, count):
+        """
+        return a list of at most count (offset, destination, payload) from offset
+        messages which are deleted by retention are skipped
+        """
+        records = list()
+        for segment in self.__segments:
+            if len(records) >= count:
+                break
+            if offset >= segment.next_offset:
+                continue
+            for index in range(max(offset - segment.base_offset, 0), len(segment.positions)):
+                records.append(segment.read(index))
+                if len(records) >= count:
+                    break
+        return records
+
+    def flush(self):
+        """
+        write appended messages to disk
+        """
+        for segment in self.__segments:
+            segment.flush()
+
+    def close(self):
+        for segment in self.__segments:
+            segment.close()
+        self.__segments = list()
+
+
+class _LogCursor():
+    """
+    reads messages matched destination regex from message log, see _Outbox.replay()
+    """
+
+    def __init__(self, log, destination_regex, offset):
+        self.__log = log
+        self.__compiled = re.compile(destination_regex)
+        self.offset = offset
+        # whether all the messages are read, then later messages are delivered by exchange
+        self.done = False
+
+    def read(self, count):
+        """
+        read next count messages, return frames of matched ones
+        """
+        frames = list()
+        for offset, destination, payload in self.__log.read(self.offset, count):
+            m = self.__compiled.match(destination)
+            if m:
+                match_result = [destination]
+                match_result += m.groups()
+                frames.append(_MessageFrame(RawContent(payload), match_result, offset))
+            self.offset = offset + 1
+        self.offset = max(self.offset, self.__log.first_offset)
+        self.done = self.offset >= self.__log.next_offset
+        return frames
+
+
+# default maximum count of frames waiting in outbound queue of one subscriber connection
+DEFAULT_QUEUE_SIZE = 1024
+
+# default policy when outbound queue is full
+DEFAULT_QUEUE_POLICY = 'drop_oldest'
+
+# seconds between checks whether a stream is drained, in case its write callback is replaced, see _Outbox
+_DRAIN_CHECK_INTERVAL = 0.1
+
+class _Outbox():
+    """
+    bounded outbound queue of one subscriber connection
+    frames are queued and written together at the end of current ioloop iteration, and then no more frames
+    are written until stream is drained, so the frames a slow subscriber cannot receive are held here and
+    limited by policy, if the queue is full while nothing is pending on stream, queued frames are written at once:
+    drop_oldest: the oldest queued frame is dropped
+    drop_newest: the incoming frame is dropped
+    conflate: only the latest frame of each destination is queued, the oldest is dropped if still full
+    disconnect: the subscriber is disconnected
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'conflate', 'disconnect')
+
+    def __init__(self, stream, write, close, size=None, policy=None):
+        """
+        stream: IOStream of connection
+        write: function which writes a list of _MessageFrame to stream
+        close: function which closes connection
+        """
+        self.__stream = stream
+        self.__write = write
+        self.__close = close
+        self.__size = size or DEFAULT_QUEUE_SIZE
+        self.__policy = policy or DEFAULT_QUEUE_POLICY
+        if self.__policy not in self.POLICIES:
+            raise ValueError('Unknown queue policy "%s"' % self.__policy)
+        # conflation queue is keyed by destination
+        self.__queue = collections.OrderedDict() if self.__policy == 'conflate' else collections.deque()
+        self.__writing = False
+        # whether written frames are waiting to be sent, and the timeout which checks it, see __wait_drained()
+        self.__draining = False
+        self.__drain_timeout = None
+        # subscription identification -> message log cursor being replayed, see replay()
+        self.__cursors = dict()
+        # count of frames dropped by this queue
+        self.dropped = 0
+
+    def put(self, frame):
+        if self.__stream.closed():
+            return
+        self.__start()
+        if self.__is_full(frame) and not (self.__draining and self.__stream.writing()):
+            # subscriber is not slow, the queue is just filled in one ioloop iteration
+            self.__write_queued()
+        if self.__policy == 'conflate':
+            destination = frame.match[0]
+            if destination in self.__queue:
+                self.__queue[destination] = frame
+                self.__drop()
+                return
+            self.__queue[destination] = frame
+            if len(self.__queue) > self.__size:
+                self.__queue.popitem(last=False)
+                self.__drop()
+        elif len(self.__queue) < self.__size:
+            self.__queue.append(frame)
+        elif self.__policy == 'drop_oldest':
+            self.__queue.popleft()
+            self.__queue.append(frame)
+            self.__drop()
+        elif self.__policy == 'drop_newest':
+            self.__drop()
+        else:
+            logging.warning('Outbound queue is full, disconnecting')
+            counters['outbound_disconnected'] += 1
+            self.__queue.clear()
+            self.__close()
+
+    def __is_full(self, frame):
+        if self.__policy == 'conflate' and frame.match[0] in self.__queue:
+            return False
+        return len(self.__queue) >= self.__size
+
+    def __write_queued(self):
+        """
+        write queued frames without waiting stream drained, the scheduled __flush() still runs
+        """
+        if self.__policy == 'conflate':
+            frames = list(self.__queue.values())
+        else:
+            frames = list(self.__queue)
+        self.__queue.clear()
+        self.__write(frames)
+
+    def __start(self):
+        if not self.__writing:
+            self.__writing = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.__flush)
+
+    def replay(self, destination_regex, from_offset):
+        """
+        subscribe destination regex, messages from from_offset of message log are sent first, and then
+        messages delivered by exchange
+        messages are read from message log as many as queue size each time stream is drained, so they are never
+        dropped, and are not held in memory
+        return an identification for subscription removal
+        """
+        if exchange.log is None:
+            raise Exception('Message log is not enabled')
+        cursor = _LogCursor(exchange.log, destination_regex, from_offset)
+        id = exchange.add(destination_regex, functools.partial(self.__put_after, cursor), framed=True,
+            retained=False)
+        self.__cursors[id] = cursor
+        self.__start()
+        return id
+
+    def stop_replay(self, id):
+        """
+        stop reading message log of a subscription, called when it is removed
+        """
+        self.__cursors.pop(id, None)
+
+    def __put_after(self, cursor, frame):
+        """
+        messages delivered before cursor reaches the end of message log are also read by cursor
+        """
+        if cursor.done:
+            self.put(frame)
+
+    def __drop(self):
+        self.dropped += 1
+        counters['outbound_dropped'] += 1
+
+    def __flush(self):
+        """
+        write all the queued frames at once, then wait stream drained
+        """
+        if self.__stream.closed():
+            return
+        if self.__policy == 'conflate':
+            frames = list(self.__queue.values())
+        else:
+            frames = list(self.__queue)
+        self.__queue.clear()
+        for id, cursor in list(self.__cursors.items()):
+            frames += cursor.read(self.__size)
+            if cursor.done:
+                del self.__cursors[id]
+        if not frames:
+            if self.__cursors:
+                # nothing matched in messages read, continue in next ioloop iteration
+                tornado.ioloop.IOLoop.instance().add_callback(self.__flush)
+            else:
+                self.__writing = False
+            return
+        self.__write(frames)
+        self.__wait_drained()
+
+    def __wait_drained(self):
+        """
+        flush again after stream is drained
+        empty write just replaces stream's write callback, which is run after write buffer is flushed, but any other
+        write to the stream, such as error frames or WebSocket pong frames, replaces it again, so stream is also
+        checked periodically
+        """
+        self.__draining = True
+        self.__stream.write(b'', self.__on_drained)
+        self.__drain_timeout = tornado.ioloop.IOLoop.instance().add_timeout(time.time() + _DRAIN_CHECK_INTERVAL,
+            self.__check_drained)
+
+    def __check_drained(self):
+        self.__drain_timeout = None
+        if not self.__draining or self.__stream.closed():
+            return
+        if self.__stream.writing():
+            self.__drain_timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + _DRAIN_CHECK_INTERVAL, self.__check_drained)
+        else:
+            self.__on_drained()
+
+    def __on_drained(self):
+        if not self.__draining:
+            return
+        self.__draining = False
+        if self.__drain_timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self.__drain_timeout)
+            self.__drain_timeout = None
+        self.__flush()
 
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
@@ -195,11 +1471,13 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         self.__address = self.request.connection.address
         logging.debug('%s connected', self.__address)
         self.__subscriptions = dict()
+        self.__outbox = _Outbox(self.stream, self.__write_frames, self.close,
+            self.settings.get('messaging_queue_size'), self.settings.get('messaging_queue_policy'))
 
     def on_message(self, message):
         logging.debug(self.request.headers.get('Authorization'))
         try:
-            parsed = json.loads(message)
+            parsed = tore.codec.loads(message)
             type = parsed['type']
             destination = parsed['destination']
             if type == 'publish':
@@ -210,8 +1488,11 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
             elif type == 'subscribe':
                 if destination in self.__subscriptions:
                     raise Exception('Destination "%s" already exists' % destination)
+                elif parsed.get('from_offset') is not None:
+                    self.__subscriptions[destination] = self.__outbox.replay(destination, parsed['from_offset'])
+                    logging.debug('%s subscribes "%s" from %d', self.__address, destination, parsed['from_offset'])
                 else:
-                    id = exchange.add(destination, self.callback)
+                    id = exchange.add(destination, self.callback, framed=True)
                     self.__subscriptions[destination] = id
                     logging.debug('%s subscribes "%s"', self.__address, destination)
             elif type == 'unsubscribe':
@@ -220,6 +1501,7 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
                 else:
                     id = self.__subscriptions[destination]
                     exchange.remove(id)
+                    self.__outbox.stop_replay(id)
                     del self.__subscriptions[destination]
             else:
                 raise Exception('Unknown message type "%s"', type)
@@ -229,16 +1511,19 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
 
     def on_close(self):
         logging.debug('%s disconnected, all subscription from which will be cleaned', self.__address)
-        for destination in self.__subscriptions:
-            id = self.__subscriptions[destination]
-            exchange.remove(id)
+        exchange.remove_many(self.__subscriptions.values())
         del self.__subscriptions
 
-    def callback(self, content, match):
+    def callback(self, frame):
         """
         message callback
         """
-        self.write_message(message_frame(content, match))
+        self.__outbox.put(frame)
+
+    def __write_frames(self, frames):
+        # encoded frame is sent as text frame without encoding it again
+        for frame in frames:
+            self.write_message(frame.encoded)
 
 
 class TCPConnection():
@@ -246,69 +1531,143 @@ class TCPConnection():
     TCP connection handler
     """
 
-    def __init__(self, stream, address):
+    def __init__(self, stream, address, queue_size=None, queue_policy=None):
         self.__stream = stream
         self.__address = address
         logging.debug('%s connected', self.__address)
         self.__subscriptions = dict()
+        self.__outbox = _Outbox(stream, self.__write_frames, stream.close, queue_size, queue_policy)
+        # Json framing by default, client may switch to binary framing by a framing frame
+        self.__binary = False
+        # whether connection is a federation link from another node
+        self.__link = False
         self.__stream.set_close_callback(self.__on_close)
         self.__message_callback = tornado.stack_context.wrap(self.__on_message)
-        self.__stream.read_until(b'\0', self.__message_callback)
+        self.__length_callback = tornado.stack_context.wrap(self.__on_length)
+        self.__binary_callback = tornado.stack_context.wrap(self.__on_binary_message)
+        self.__read()
+
+    def __read(self):
+        """
+        read next client frame
+        """
+        if self.__stream.closed():
+            return
+        if self.__binary:
+            self.__stream.read_bytes(4, self.__length_callback)
+        else:
+            self.__stream.read_until(b'\0', self.__message_callback)
 
     def __on_message(self, message):
         """
-        handle client frames
+        handle client Json frames
         """
         try:
             # Notice to remove tailed '\0'
-            msg = message[:-1].decode()
-            logging.debug(msg)
-            parsed = json.loads(msg)
-            type = parsed['type']
-            destination = parsed['destination']
-            if type == 'publish':
-                content = parsed['content']
-                exchange.push(content, destination)
-            elif type == 'subscribe':
-                if destination in self.__subscriptions:
-                    raise Exception('Destination "%s" already exists' % destination)
-                else:
-                    id = exchange.add(destination, self.__callback)
-                    self.__subscriptions[destination] = id
-                    logging.debug('%s subscribes "%s"', self.__address, destination)
-            elif type == 'unsubscribe':
-                if destination not in self.__subscriptions:
-                    raise Exception('Destination "%s" not exists' % destination)
-                else:
-                    id = self.__subscriptions[destination]
-                    exchange.remove(id)
-                    del self.__subscriptions[destination]
+            parsed = tore.codec.loads(message[:-1])
+            logging.debug(parsed)
+            if parsed['type'] == 'framing':
+                if parsed['framing'] != 'binary':
+                    raise Exception('Unknown framing "%s"' % parsed['framing'])
+                self.__binary = True
+            elif parsed['type'] == 'link':
+                self.__binary = True
+                if parsed['node'] == node_id:
+                    self.__stream.write(binary_error_frame(_SELF_LINK_ERROR), self.__stream.close)
+                    return
+                self.__link = True
+                logging.info('Federation link from %s', self.__address)
             else:
-                raise Exception('Unknown message type "%s"', type)
+                self.__handle(parsed)
         except Exception as ex:
-            logging.warning(ex)
-            if not self.__stream.closed():
-                self.__stream.write(error_frame(str(ex)).encode() + b'\0')
+            self.__error(ex)
+        self.__read()
+
+    def __on_length(self, data):
+        """
+        handle length prefix of client binary frames
+        """
+        length, = struct.unpack('!I', data)
+        if not 0 < length <= BINARY_MAX_LENGTH:
+            self.__error(Exception('Invalid frame length %d' % length))
+            self.__stream.close()
+            return
+        self.__stream.read_bytes(length, self.__binary_callback)
+
+    def __on_binary_message(self, body):
+        """
+        handle client binary frames, published payload is not parsed
+        """
+        try:
+            self.__handle(parse_binary_frame(body))
+        except Exception as ex:
+            self.__error(ex)
+        self.__read()
 
+    def __handle(self, parsed):
+        type = parsed['type']
+        if type == 'publish_batch':
+            exchange.push_many((message['content'], message['destination']) for message in parsed['messages'])
+            return
+        destination = parsed['destination']
+        if type == 'publish':
+            content = parsed['content']
+            exchange.push(content, destination)
+        elif type == 'subscribe':
+            if destination in self.__subscriptions:
+                raise Exception('Destination "%s" already exists' % destination)
+            elif parsed.get('from_offset') is not None:
+                self.__subscriptions[destination] = self.__outbox.replay(destination, parsed['from_offset'])
+                logging.debug('%s subscribes "%s" from %d', self.__address, destination, parsed['from_offset'])
+            else:
+                # messages from other nodes are not sent to federation links, and retained messages are kept by
+                # each node itself
+                id = exchange.add(destination, self.__callback, framed=True, retained=not self.__link,
+                    federation=self.__link)
+                self.__subscriptions[destination] = id
+                logging.debug('%s subscribes "%s"', self.__address, destination)
+        elif type == 'unsubscribe':
+            if destination not in self.__subscriptions:
+                raise Exception('Destination "%s" not exists' % destination)
+            else:
+                id = self.__subscriptions[destination]
+                exchange.remove(id)
+                self.__outbox.stop_replay(id)
+                del self.__subscriptions[destination]
+        else:
+            raise Exception('Unknown message type "%s"', type)
+
+    def __error(self, ex):
+        """
+        send error frame back
+        """
+        logging.warning(ex)
         if not self.__stream.closed():
-            self.__stream.read_until(b'\0', self.__message_callback)
+            if self.__binary:
+                self.__stream.write(binary_error_frame(str(ex)))
+            else:
+                self.__stream.write(error_frame(str(ex)) + b'\0')
 
     def __on_close(self):
         """
         handle socket close event
         """
         logging.debug('%s disconnected, all subscription from which will be cleaned', self.__address)
-        for destination in self.__subscriptions:
-            id = self.__subscriptions[destination]
-            exchange.remove(id)
+        exchange.remove_many(self.__subscriptions.values())
         del self.__subscriptions
 
-    def __callback(self, content, match):
+    def __callback(self, frame):
         """
         message callback
         """
-        if not self.__stream.closed():
-            self.__stream.write(message_frame(content, match).encode() + b'\0')
+        self.__outbox.put(frame)
+
+    def __write_frames(self, frames):
+        # coalesced into one write
+        if self.__binary:
+            self.__stream.write(b''.join([frame.binary for frame in frames]))
+        else:
+            self.__stream.write(b''.join([frame.data for frame in frames]))
 
 
 class TCPServer(tornado.netutil.TCPServer):
@@ -316,66 +1675,502 @@ class TCPServer(tornado.netutil.TCPServer):
     TCP implementation
     """
 
+    def __init__(self, queue_size=None, queue_policy=None, **kwargs):
+        """
+        queue_size: maximum count of frames waiting in outbound queue of one connection
+        queue_policy: policy when outbound queue is full, see _Outbox
+        """
+        tornado.netutil.TCPServer.__init__(self, **kwargs)
+        self.__queue_size = queue_size
+        self.__queue_policy = queue_policy
+
     def handle_stream(self, stream, address):
-        TCPConnection(stream, address)
+        TCPConnection(stream, address, self.__queue_size, self.__queue_policy)
+
 
+# default maximum size of UDP datagram, larger datagrams are truncated and dropped
+DEFAULT_UDP_MAX_SIZE = 65507
+
+# maximum count of datagrams received in one ioloop event, so that other connections are not starved
+_UDP_MAX_BATCH = 1024
 
 class UDPServer():
     """
     UDP implementation
+    every datagram is a Json or binary publish or publish_batch frame
     """
 
-    def __init__(self):
+    def __init__(self, max_size=None, receive_buffer=None):
+        """
+        max_size: maximum size of datagram
+        receive_buffer: size of socket receive buffer (SO_RCVBUF), system default if None
+        """
         self.__sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.__max_size = max_size or DEFAULT_UDP_MAX_SIZE
+        if receive_buffer:
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        # one more byte to detect truncated datagrams
+        self.__buffer = bytearray(self.__max_size + 1)
 
     def listen(self, port):
+        self.bind(port)
+        self.start()
+
+    def bind(self, port):
+        """
+        bind socket only, can be called before forking processes so that all of them share the socket
+        """
         self.__sock.bind(('', port))
         self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.__sock.setblocking(0)
+
+    def start(self):
+        """
+        start receiving on ioloop
+        """
         io_loop = tornado.ioloop.IOLoop.instance()
         io_loop.add_handler(self.__sock.fileno(), self.__handler, io_loop.READ)
 
     def __handler(self, fd, events):
-        data, addr = self.__sock.recvfrom(1024)
+        # drain the socket, and push all the messages into exchange at once
+        messages = list()
+        for i in range(_UDP_MAX_BATCH):
+            try:
+                size = self.__sock.recv_into(self.__buffer)
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            counters['udp_received'] += 1
+            if size > self.__max_size:
+                counters['udp_truncated'] += 1
+                counters['udp_dropped'] += 1
+                logging.warning('UDP datagram larger than %d bytes is dropped', self.__max_size)
+                continue
+            try:
+                messages += self.__parse(bytes(self.__buffer[:size]))
+            except Exception as ex:
+                counters['udp_parse_errors'] += 1
+                counters['udp_dropped'] += 1
+                logging.warning(ex)
+        if messages:
+            exchange.push_many(messages)
+
+    def __parse(self, data):
+        """
+        parse datagram to list of (content, destination)
+        """
+        # length prefix of binary frame always starts with 0 byte
+        if data[:1] == b'\0':
+            parsed = parse_binary_frame(data[4:])
+        else:
+            parsed = tore.codec.loads(data)
+#            logging.debug(parsed)
+        type = parsed['type']
+        if type == 'publish':
+            return [(parsed['content'], parsed['destination'])]
+        elif type == 'publish_batch':
+            return [(message['content'], message['destination']) for message in parsed['messages']]
+        else:
+            raise Exception('Unknown message type "%s"' % type)
+
+
+# seconds before connecting to another process again
+_BUS_RETRY_INTERVAL = 0.1
+
+
+def _split_binary_frames(buffer):
+    """
+    remove all the complete length prefixed binary frames from the beginning of buffer (a bytearray), and return
+    their bodies
+    """
+    bodies = list()
+    offset = 0
+    while len(buffer) - offset >= 4:
+        length, = struct.unpack_from('!I', buffer, offset)
+        if len(buffer) - offset - 4 < length:
+            break
+        bodies.append(bytes(buffer[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+    del buffer[:offset]
+    return bodies
+
+
+class ProcessBus():
+    """
+    Unix stream socket bus between the processes forked by tore.start_server()
+    every message delivered in one process is forwarded to all the other processes as binary publish frame, which
+    is buffered by the stream, so messages of any size are not dropped
+    """
+
+    def __init__(self, path_format, task_id, processes):
+        """
+        path_format: socket file path containing "%d" which is replaced by task id
+        task_id: task id of current process, from 0 to processes - 1
+        processes: count of processes
+        """
+        self.__path = path_format % task_id
+        self.__peer_paths = [path_format % i for i in range(processes) if i != task_id]
+        # socket file path -> connected IOStream of another process
+        self.__peers = dict()
+        self.__closed = False
+        self.__sock = tornado.netutil.bind_unix_socket(self.__path)
+        atexit.register(self.close)
+        # atexit is not run if the process is terminated by signal
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, self.__on_terminate)
+
+    def start(self):
+        """
+        start accepting other processes and connecting to them on ioloop, and forwarding messages of exchange
+        """
+        tornado.netutil.add_accept_handler(self.__sock, self.__on_accept)
+        for path in self.__peer_paths:
+            self.__connect(path)
+        exchange.add_forwarder(self)
+
+    def __connect(self, path):
+        if self.__closed:
+            return
+        stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        stream.set_close_callback(functools.partial(self.__on_close, path))
+        stream.connect(path, functools.partial(self.__on_connect, path, stream))
+
+    def __on_connect(self, path, stream):
+        logging.info('Process "%s" is connected', path)
+        self.__peers[path] = stream
+
+    def __on_close(self, path):
+        # peer is not started yet, or restarted
+        if self.__peers.pop(path, None) and not self.__closed:
+            logging.warning('Process "%s" is disconnected, messages to it are dropped until it is connected again',
+                path)
+        if not self.__closed:
+            tornado.ioloop.IOLoop.instance().add_timeout(time.time() + _BUS_RETRY_INTERVAL,
+                functools.partial(self.__connect, path))
+
+    def forward(self, message, destination, origin):
+        # messages from other nodes are received by federation links of every process
+        if origin is self or isinstance(origin, _FederationLink):
+            return
+        # encoded once for all the peers
+        frame = None
+        for path in self.__peer_paths:
+            stream = self.__peers.get(path)
+            if stream is None or stream.closed():
+                # logged once when disconnected, see __on_close()
+                counters['bus_dropped'] += 1
+                continue
+            if frame is None:
+                frame = binary_publish_frame(_content_bytes(message), destination)
+            stream.write(frame)
+
+    def __on_accept(self, connection, address):
+        stream = tornado.iostream.IOStream(connection)
+        stream.read_until_close(lambda data: None, functools.partial(self.__on_data, bytearray()))
+
+    def __on_data(self, buffer, data):
+        """
+        messages of all the complete frames received are pushed at once
+        """
+        buffer += data
+        messages = list()
+        for body in _split_binary_frames(buffer):
+            try:
+                parsed = parse_binary_frame(body)
+                messages.append((parsed['content'], parsed['destination']))
+            except Exception as ex:
+                counters['bus_errors'] += 1
+                logging.warning(ex)
+        if messages:
+            exchange.push_many(messages, self)
+
+    def close(self):
+        """
+        close sockets and remove socket file
+        """
+        self.__closed = True
+        for stream in list(self.__peers.values()):
+            stream.close()
         try:
-            msg = data.decode()
-#            logging.debug(msg)
-            parsed = json.loads(msg)
-            type = parsed['type']
-            destination = parsed['destination']
-            if type == 'publish':
-                content = parsed['content']
-                exchange.push(content, destination)
+            self.__sock.close()
+            os.unlink(self.__path)
         except Exception as ex:
-            logging.warning(ex)
+            logging.debug(ex)
+
+    def __on_terminate(self, signum, frame):
+        """
+        remove socket file, then terminated by the signal as usual, so that the parent process sees the same status
+        """
+        self.close()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+# seconds before reconnecting a closed federation link, doubled after each failure up to the maximum
+FEDERATION_RETRY_INTERVAL = 1
+FEDERATION_MAX_RETRY_INTERVAL = 30
+
+_SELF_LINK_ERROR = 'Node links to itself'
+
+
+class _FederationLink():
+    """
+    TCP connection to the messaging port of another node, see Federation
+    local interests of this node are subscribed on the peer, and the messages received are pushed to local exchange
+    """
+
+    def __init__(self, host, port):
+        self.__host = host
+        self.__port = port
+        self.__stream = None
+        self.__connected = False
+        self.__stopped = False
+        # destination regexes subscribed on the peer
+        self.__subscribed = set()
+        # received bytes which are not a complete frame yet
+        self.__buffer = bytearray()
+        self.__retry_interval = FEDERATION_RETRY_INTERVAL
+
+    def connect(self):
+        if self.__stopped:
+            return
+        self.__stream = tornado.iostream.IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        self.__stream.set_close_callback(self.__on_close)
+        self.__stream.connect((self.__host, self.__port), self.__on_connect)
 
+    def __on_connect(self):
+        logging.info('Federation link to %s:%d is connected', self.__host, self.__port)
+        self.__connected = True
+        self.__retry_interval = FEDERATION_RETRY_INTERVAL
+        self.__buffer = bytearray()
+        self.__subscribed = set(exchange.interests())
+        # link frame also switches the connection to binary framing
+        self.__stream.write(b''.join([link_frame(node_id), b'\0'] +
+            [binary_subscribe_frame(destination_regex) for destination_regex in self.__subscribed]))
+        self.__stream.read_until_close(self.__on_end, self.__on_data)
+
+    def interest(self, destination_regex, interested):
+        """
+        subscribe or unsubscribe destination regex on the peer
+        """
+        if not self.__connected:
+            return
+        if interested and destination_regex not in self.__subscribed:
+            self.__subscribed.add(destination_regex)
+            self.__stream.write(binary_subscribe_frame(destination_regex))
+        elif not interested and destination_regex in self.__subscribed:
+            self.__subscribed.discard(destination_regex)
+            self.__stream.write(binary_unsubscribe_frame(destination_regex))
+
+    def __on_data(self, data):
+        """
+        messages of all the complete frames received are pushed at once
+        """
+        self.__buffer += data
+        messages = list()
+        for body in _split_binary_frames(self.__buffer):
+            parsed = parse_binary_frame(body)
+            if parsed['type'] == 'message':
+                messages.append((parsed['content'], parsed['match'][0]))
+            elif parsed['type'] == 'error':
+                logging.warning('Federation link to %s:%d: %s', self.__host, self.__port, parsed['content'])
+                if parsed['content'] == _SELF_LINK_ERROR:
+                    self.__stopped = True
+        counters['federation_received'] += len(messages)
+        if messages:
+            exchange.push_many(messages, self)
+
+    def __on_end(self, data):
+        pass
+
+    def __on_close(self):
+        self.__connected = False
+        if self.__stopped:
+            return
+        logging.warning('Federation link to %s:%d is closed, reconnecting in %d seconds', self.__host, self.__port,
+            self.__retry_interval)
+        tornado.ioloop.IOLoop.instance().add_timeout(time.time() + self.__retry_interval, self.connect)
+        self.__retry_interval = min(self.__retry_interval * 2, FEDERATION_MAX_RETRY_INTERVAL)
+
+    def close(self):
+        self.__stopped = True
+        if self.__stream is not None:
+            self.__stream.close()
+
+
+class Federation():
+    """
+    links this node to other nodes through their TCP messaging ports, so that messages pushed in any node are
+    delivered to the subscribers of all the nodes
+    every node links to all the others, and subscribes on them only the destination regexes which have local
+    subscribers, so messages are only sent to the nodes which need them, and messages from other nodes are never
+    sent to other nodes again
+    messages sent through a link are coalesced into one write each ioloop iteration by the outbound queue of peer,
+    and all the messages received in one read are pushed at once
+    """
+
+    def __init__(self, peers):
+        """
+        peers: list of "host:port" of TCP messaging ports of other nodes, this node itself is ignored if listed
+        """
+        self.__links = list()
+        for peer in peers:
+            host, port = peer.rsplit(':', 1)
+            self.__links.append(_FederationLink(host, int(port)))
+
+    def start(self):
+        """
+        connect to all the peers, must be called on IOLoop thread
+        """
+        exchange.add_interest_listener(self.__on_interest)
+        for link in self.__links:
+            link.connect()
+
+    def __on_interest(self, destination_regex, interested):
+        # listener may be called on any thread
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(self.__interest, destination_regex, interested))
+
+    def __interest(self, destination_regex, interested):
+        for link in self.__links:
+            link.interest(destination_regex, interested)
+
+    def close(self):
+        exchange.remove_interest_listener(self.__on_interest)
+        for link in self.__links:
+            link.close()
+
+
+# default maximum size of datagram sent by batching UDP client, which fits in Ethernet MTU
+DEFAULT_UDP_BATCH_SIZE = 1400
+
+# default seconds which batching UDP client waits before flushing
+DEFAULT_UDP_FLUSH_INTERVAL = 0.01
+
+_BATCH_PREFIX = b'{"type":"publish_batch","messages":['
+
+_BATCH_SUFFIX = b']}'
 
 class UDPClient():
     """
     UDP client, only message publishing is supported
+    in batch mode, published messages are buffered and packed into publish_batch datagrams,
+    which are sent by a background thread when buffer reaches max_size or every flush_interval seconds
     """
 
-    def __init__(self, host='localhost', port=8154):
+    def __init__(self, host='localhost', port=8154, batch=False, max_size=None, flush_interval=None,
+                 conflate=False):
         """
         host: message server address
         port: message server port
+        batch: enable batch mode
+        max_size: maximum size of batch datagram
+        flush_interval: maximum seconds a message waits in buffer
+        conflate: only buffer the latest message of each destination
         """
         # client socket
         self.__socket = socket.socket(type=socket.SOCK_DGRAM)
         self.__socket.connect((host, port))
+        self.__batch = batch
+        if not batch:
+            return
+        self.__max_size = max_size or DEFAULT_UDP_BATCH_SIZE
+        self.__flush_interval = flush_interval or DEFAULT_UDP_FLUSH_INTERVAL
+        self.__conflate = conflate
+        # encoded publish frames, keyed by destination if conflated
+        self.__buffer = collections.OrderedDict() if conflate else list()
+        self.__buffer_size = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__flush_thread = threading.Thread(target=self.__flusher)
+        self.__flush_thread.daemon = True
+        self.__flush_thread.start()
 
     def publish(self, content, destination):
         try:
-            self.__socket.send(publish_frame(content, destination).encode())
+            frame = publish_frame(content, destination)
+            if not self.__batch:
+                self.__socket.send(frame)
+                return
+            with self.__condition:
+                if self.__conflate:
+                    replaced = self.__buffer.pop(destination, None)
+                    if replaced is not None:
+                        self.__buffer_size -= len(replaced) + 1
+                    self.__buffer[destination] = frame
+                else:
+                    self.__buffer.append(frame)
+                # 1 byte for separator
+                self.__buffer_size += len(frame) + 1
+                if self.__buffer_size + len(_BATCH_PREFIX) + len(_BATCH_SUFFIX) >= self.__max_size:
+                    self.__condition.notify()
         except Exception as ex:
             logging.warning(ex)
 
+    def flush(self):
+        """
+        send all the buffered messages now
+        """
+        with self.__condition:
+            if self.__conflate:
+                frames = list(self.__buffer.values())
+            else:
+                frames = self.__buffer
+            self.__buffer = collections.OrderedDict() if self.__conflate else list()
+            self.__buffer_size = 0
+        for datagram in self.__pack(frames):
+            try:
+                self.__socket.send(datagram)
+            except Exception as ex:
+                logging.warning(ex)
+
+    def __pack(self, frames):
+        """
+        pack encoded publish frames into datagrams not larger than max size
+        a frame larger than max size is sent alone
+        """
+        overhead = len(_BATCH_PREFIX) + len(_BATCH_SUFFIX)
+        packed = list()
+        size = overhead
+        for frame in frames:
+            if packed and size + 1 + len(frame) > self.__max_size:
+                yield self.__join(packed)
+                packed = list()
+                size = overhead
+            packed.append(frame)
+            size += 1 + len(frame)
+        if packed:
+            yield self.__join(packed)
+
+    def __join(self, frames):
+        if len(frames) == 1:
+            return frames[0]
+        return _BATCH_PREFIX + b','.join(frames) + _BATCH_SUFFIX
+
+    def __flusher(self):
+        """
+        background flushing thread
+        """
+        while True:
+            with self.__condition:
+                if not self.__closed:
+                    self.__condition.wait(self.__flush_interval)
+                closed = self.__closed
+            self.flush()
+            if closed:
+                return
+
     def close(self):
         """
         close all resources
         """
+        if self.__batch:
+            with self.__condition:
+                self.__closed = True
+                self.__condition.notify()
+            self.__flush_thread.join()
         try:
             self.__socket.shutdown(socket.SHUT_RDWR)
             self.__socket.close()
         except Exception as ex:
-            logging.warning(ex)
\ No newline at end of file
+            logging.warning(ex)
@@ -1,18 +1,48 @@
 # -*- coding: UTF-8 -*-
 
 import base64
+import collections
 import copy
+import datetime
+import email.utils
 import functools
+import gzip
+import hashlib
+import hmac
 import io
-import json
 import logging
+import marshal
+import mimetypes
 import os
+import re
+import sys
+import threading
+import time
+import types
+import tornado
+import tornado.escape
 import tornado.httpserver
 import tornado.ioloop
 import tornado.template
+import tornado.util
 import tornado.web
+import tore.codec
 import tore.messaging
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# default size of chunks of streaming template, see "template_stream_chunk_size" setting
+DEFAULT_STREAM_CHUNK_SIZE = 4096
+
+# version of generated template code, increase it when generated code is changed, so that cached code is discarded
+_CODE_VERSION = 2
+
+# os.replace() is not available before Python 3.3
+_replace = getattr(os, 'replace', os.rename)
+
 class RequestHandler(tornado.web.RequestHandler):
     """
     RequestHandler, Loader and Template do some tuning to origin Tornado classes to support automatic code file loading
@@ -22,23 +52,62 @@ class RequestHandler(tornado.web.RequestHandler):
         settings = self.application.settings
         if "template_loader" in settings:
             return settings["template_loader"]
-        kwargs = {}
-        if "autoescape" in settings:
-            kwargs["autoescape"] = settings["autoescape"]
 
         # HERE IS THE MODIFICATION
         # load my own loader class
-        return Loader(template_path, **kwargs)
+        return create_loader(template_path, settings)
+
+    def render_stream(self, template_name, **kwargs):
+        """
+        like render(), but output is sent chunk by chunk with chunked transfer encoding as soon as it is generated
+        the handler method must be decorated by tornado.web.asynchronous, see "template_streaming" setting
+        NOTICE: javascript and css of ui modules are not embedded
+        """
+        template_path = self.get_template_path()
+        with tornado.web.RequestHandler._template_loader_lock:
+            if template_path not in tornado.web.RequestHandler._template_loaders:
+                loader = self.create_template_loader(template_path)
+                tornado.web.RequestHandler._template_loaders[template_path] = loader
+            else:
+                loader = tornado.web.RequestHandler._template_loaders[template_path]
+        namespace = self.get_template_namespace()
+        namespace.update(kwargs)
+        self.__write_chunks(loader.load(template_name).generate_stream(**namespace))
+
+    def __write_chunks(self, chunks):
+        """
+        write next chunk after previous one is sent, so that a slow client does not make output piled in memory
+        """
+        for chunk in chunks:
+            if chunk:
+                self.write(chunk)
+                self.flush(callback=functools.partial(self.__write_chunks, chunks))
+                return
+        self.finish()
+
+    def write_cached_file(self, path, content_type=None):
+        """
+        write file back from file_cache, path may be relative to "root_dir" or absolute
+        file is read again only if it is changed, suitable for fixed responses
+        """
+        root_dir = self.application.settings.get('root_dir')
+        cached = file_cache.get(os.path.join(root_dir, path))
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        elif cached.mime_type:
+            self.set_header('Content-Type', cached.mime_type)
+        if cached.data is None:
+            for chunk in cached.read_chunks():
+                self.write(chunk)
+        else:
+            self.write(cached.data)
 
     def write_html_file(self, path):
         """
         write html file back, path may be relative to "root_dir" or absolute
         used by 401, 403 error return
         """
-        root_dir = self.application.settings.get('root_dir')
-        self.set_header('Content-Type', 'text/html; charset=UTF-8')
-        with open(os.path.join(root_dir, path), "rb") as file:
-            self.write(file.read())
+        self.write_cached_file(path, 'text/html; charset=UTF-8')
 
     def write_json_text(self, txt):
         """
@@ -50,12 +119,23 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def write_json_object(self, obj):
         """
-        convert Python object to Json string
+        convert Python object to Json by tore.codec
+        datetime, Decimal, dataclass, set and UUID are also supported, see tore.codec.default
         """
-        if self.application.settings.get('debug'):
-            self.write_json_text(json.dumps(obj, indent=4, ensure_ascii=False))
+        self.write_json_text(tore.codec.dumps(obj, pretty=self.application.settings.get('debug', False)))
+
+    def write_json_stream(self, iterable, ndjson=False, chunk_size=None):
+        """
+        write items of iterable as Json array, or as newline delimited Json if ndjson is True
+        items are encoded one by one and sent chunk by chunk with chunked transfer encoding, next chunk is encoded
+        after previous one is sent, so memory usage does not grow with count of items
+        the handler method must be decorated by tornado.web.asynchronous, and the response is finished by this method
+        """
+        if ndjson:
+            self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
         else:
-            self.write_json_text(json.dumps(obj))
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.__write_chunks(_json_chunks(iterable, ndjson, chunk_size or DEFAULT_STREAM_CHUNK_SIZE))
 
     def write_plain_text(self, txt):
         """
@@ -92,10 +172,346 @@ class RequestHandler(tornado.web.RequestHandler):
         """
         convert Json string formatted request body to Python object
         """
-        return json.loads(self.get_body_as_text())
+        return tore.codec.loads(self.request.body)
+
+
+def _json_chunks(iterable, ndjson, chunk_size):
+    """
+    generate Json encoded items of iterable, joined into chunks not smaller than chunk_size except the last one
+    """
+    separator = b'\n' if ndjson else b','
+    buffer = list()
+    size = 0
+    if not ndjson:
+        buffer.append(b'[')
+    first = True
+    for item in iterable:
+        encoded = tore.codec.dumps(item)
+        if ndjson:
+            buffer.append(encoded)
+            buffer.append(separator)
+        else:
+            if not first:
+                buffer.append(separator)
+            buffer.append(encoded)
+        first = False
+        size += len(encoded) + 1
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = list()
+            size = 0
+    if not ndjson:
+        buffer.append(b']')
+    yield b''.join(buffer)
+
+
+class LRUCache():
+    """
+    size bounded LRU cache whose items expire after their ttl seconds
+    count of hits and misses are in "hits" and "misses"
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # key -> (expire time or None, value), least recently used first
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None:
+                if item[0] is None or item[0] > time.time():
+                    self.__items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self.__items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        ttl: seconds, never expire if None
+        """
+        with self.__lock:
+            self.__items[key] = (time.time() + ttl if ttl is not None else None, value)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        remove an item, or all the items if key is None
+        """
+        with self.__lock:
+            if key is None:
+                self.__items.clear()
+            else:
+                self.__items.pop(key, None)
+
+
+# default size of fragment_cache, see "fragment_cache_size" setting
+DEFAULT_FRAGMENT_CACHE_SIZE = 1024
+
+# cache of "{% cache %}" directive and functions decorated by "cached"
+fragment_cache = LRUCache(DEFAULT_FRAGMENT_CACHE_SIZE)
+
+_MISSING = object()
+
+# {% cache key ttl %}
+_CACHE_DIRECTIVE = re.compile(r'{%\s*cache\s+(.*?)\s*%}', re.DOTALL)
+
+
+def _hashable(obj):
+    """
+    convert lists and dicts, such as request.arguments, to something can be used as cache key
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_hashable(i) for i in obj)
+    if isinstance(obj, set):
+        return frozenset(obj)
+    return obj
+
+
+def _cache_fragment(buffer, key, ttl):
+    """
+    used by "{% cache %}", the block body is rendered by iterating this generator only if it is not cached
+    """
+    key = _hashable(key)
+    value = fragment_cache.get(key)
+    if value is not None:
+        buffer.append(value)
+        return
+    start = len(buffer)
+    yield
+    fragment_cache.set(key, b''.join(buffer[start:]), ttl)
+
+
+def _compile_cache_directives(text, name):
+    """
+    convert "{% cache key ttl %}...{% end %}" to a for loop, the key is prefixed by template name and line number
+    """
+
+    def convert(match):
+        parts = match.group(1).rsplit(None, 1)
+        if len(parts) != 2:
+            raise tornado.template.ParseError("cache missing key or ttl in %s" % name)
+        line = text.count('\n', 0, match.start()) + 1
+        return '{%% for _fragment in _cache_fragment(_buffer, (%r, %d, %s), %s) %%}' % (
+            name, line, parts[0], parts[1])
+
+    return _CACHE_DIRECTIVE.sub(convert, text)
+
+
+def cached(ttl, key=None):
+    """
+    decorator of functions in code files, the result is cached in fragment_cache for ttl seconds
+    key: function to make cache key from the same arguments, such as lambda user, page: user, default is all
+    the arguments
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            k = _hashable((function.__module__, function.__name__,
+                           key(*args, **kwargs) if key else (args, kwargs)))
+            value = fragment_cache.get(k, _MISSING)
+            if value is _MISSING:
+                value = function(*args, **kwargs)
+                fragment_cache.set(k, value, ttl)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def create_loader(template_path, settings):
+    """
+    create template loader by application settings
+    """
+    kwargs = {}
+    if "autoescape" in settings:
+        kwargs["autoescape"] = settings["autoescape"]
+    cache_path = settings.get('template_cache_path')
+    if cache_path:
+        kwargs["cache_path"] = os.path.join(settings.get('root_dir') or os.getcwd(), cache_path)
+    if settings.get('debug') or settings.get('template_debug_dump'):
+        kwargs["debug_dump"] = True
+    check_interval = settings.get('template_check_interval')
+    if check_interval is None and settings.get('debug'):
+        check_interval = 0
+    if check_interval is not None:
+        kwargs["check_interval"] = check_interval
+        # in debug mode, changes are seen by the very next request
+        kwargs["background"] = not settings.get('debug')
+    if settings.get('template_streaming'):
+        kwargs["stream_chunk_size"] = settings.get('template_stream_chunk_size') or DEFAULT_STREAM_CHUNK_SIZE
+    return Loader(template_path, **kwargs)
+
+
+class CodeCache():
+    """
+    on-disk cache of compiled template code, similar to __pycache__
+    each template has one cache file which contains marshal'd (digest, code, compiled code object),
+    it is used only if digest matches, see Template.digest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __filename(self, name):
+        return os.path.join(self.path, hashlib.sha1(name.encode()).hexdigest() + '.tc')
+
+    def load(self, name, digest):
+        """
+        return (code, compiled) or None
+        """
+        try:
+            with open(self.__filename(name), 'rb') as f:
+                cached_digest, code, compiled = marshal.load(f)
+        except Exception:
+            # not exists, or written by another Python version
+            return None
+        if cached_digest != digest:
+            return None
+        return code, compiled
+
+    def save(self, name, digest, code, compiled):
+        filename = self.__filename(name)
+        temp_filename = '%s.%d' % (filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as f:
+                marshal.dump((digest, code, compiled), f)
+            # replaced atomically so that other processes never read a partial file
+            _replace(temp_filename, filename)
+        except Exception as ex:
+            logging.warning(ex)
 
 
 class Loader(tornado.template.Loader):
+    def __init__(self, root_directory, cache_path=None, debug_dump=False, check_interval=None, background=True,
+                 stream_chunk_size=None, **kwargs):
+        """
+        cache_path: directory of compiled template cache, disabled if None
+        debug_dump: whether to output the final code generated by engine when a template is compiled
+        check_interval: seconds between two checks of modification time of one file, changed templates and the
+            templates depend on them are recompiled, disabled if None
+        background: whether changed templates are recompiled in a background thread, during which the old ones
+            are still used, otherwise they are recompiled before loading
+        stream_chunk_size: if set, templates are also compiled to be generated chunk by chunk, see
+            Template.generate_stream
+        """
+        tornado.template.Loader.__init__(self, root_directory, **kwargs)
+        self.cache = CodeCache(cache_path) if cache_path else None
+        self.debug_dump = debug_dump
+        self.check_interval = check_interval
+        self.background = background
+        self.stream_chunk_size = stream_chunk_size
+        # path -> (checked time, modification time)
+        self.__mtimes = {}
+        self.__rebuilding = False
+        self.__local = threading.local()
+
+    def reset(self):
+        # if files are checked, there's no need to throw away all the templates, Tornado does it for every request
+        # in debug mode
+        if self.check_interval is None:
+            tornado.template.Loader.reset(self)
+
+    def load(self, name, parent_path=None):
+        name = self.resolve_path(name, parent_path=parent_path)
+        building = getattr(self.__local, 'building', None)
+        if building is not None:
+            # called by __rebuild(), stale templates are recompiled into "fresh", others are shared
+            stale, fresh = building
+            if name not in fresh:
+                template = self.templates.get(name)
+                if template is not None and name not in stale:
+                    return template
+                fresh[name] = self._create_template(name)
+            return fresh[name]
+        with self.lock:
+            template = self.templates.get(name)
+            if template is None:
+                template = self.templates[name] = self._create_template(name)
+            elif self.check_interval is not None and self.__changed(template):
+                if self.background:
+                    if not self.__rebuilding:
+                        self.__rebuilding = True
+                        thread = threading.Thread(target=self.__rebuild)
+                        thread.daemon = True
+                        thread.start()
+                else:
+                    self.__rebuild()
+                    template = self.templates.get(name)
+                    if template is None:
+                        # failed again, raise the error
+                        template = self.templates[name] = self._create_template(name)
+            return template
+
+    def __mtime(self, path, interval):
+        """
+        modification time of a file, or None if not exists, checked at most once in "interval" seconds
+        """
+        now = time.time()
+        checked = self.__mtimes.get(path)
+        if checked and now - checked[0] < interval:
+            return checked[1]
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        self.__mtimes[path] = (now, mtime)
+        return mtime
+
+    def __changed(self, template):
+        """
+        whether files of a template or of templates it depends on are changed
+        """
+        for path, mtime in template.files.items():
+            if self.__mtime(path, self.check_interval) != mtime:
+                return True
+        for name, dependency in template.dependencies.items():
+            if self.templates.get(name) is not dependency or self.__changed(dependency):
+                return True
+        return False
+
+    def __rebuild(self):
+        """
+        recompile changed templates and swap them in at once
+        """
+        try:
+            stale = set(name for name, template in list(self.templates.items()) if self.__changed(template))
+            fresh = {}
+            self.__local.building = (stale, fresh)
+            try:
+                for name in stale:
+                    try:
+                        self.load(name)
+                    except Exception:
+                        logging.exception('Failed to recompile template %s', name)
+            finally:
+                self.__local.building = None
+            with self.lock:
+                # failed ones are removed, so that the error is raised when loading
+                for name in stale:
+                    self.templates.pop(name, None)
+                self.templates.update(fresh)
+            if fresh:
+                logging.info('Recompiled templates: %s', ', '.join(sorted(fresh)))
+        finally:
+            self.__rebuilding = False
+
     def _create_template(self, name):
         path = os.path.join(self.root, name)
         f = open(path, "rb")
@@ -113,15 +529,177 @@ class Loader(tornado.template.Loader):
 
         # load my own template class
         template = Template(template_string, source_string, name=name, loader=self)
+        # modification time of files when they are read
+        template.files = dict((p, self.__mtime(p, 0)) for p in (path, path + '.py'))
         return template
 
 
+# namespaces of renderings in progress in current thread, innermost last, see _ModuleNamespace
+_rendering = threading.local()
+
+
+class _ModuleNamespace(dict):
+    """
+    globals of a code file module, names are looked up in the namespace of current rendering first, so that every
+    function of the module, including decorated ones, lambdas, closures and methods, can use arguments of rendering
+    as global variables, and sees names overridden by code files of child templates
+    """
+
+    def __getitem__(self, name):
+        namespaces = getattr(_rendering, 'namespaces', None)
+        if namespaces:
+            namespace = namespaces[-1]
+            if name in namespace:
+                return namespace[name]
+        return dict.__getitem__(self, name)
+
+
+def _render(namespace, function, *args):
+    """
+    call function with namespace as the current rendering
+    """
+    namespaces = getattr(_rendering, 'namespaces', None)
+    if namespaces is None:
+        namespaces = _rendering.namespaces = []
+    namespaces.append(namespace)
+    try:
+        return function(*args)
+    finally:
+        namespaces.pop()
+
+
+def _find_includes(node):
+    """
+    find all the {% include %} blocks in a template node tree
+    """
+    if isinstance(node, tornado.template._IncludeBlock):
+        yield node
+    for child in node.each_child():
+        for include in _find_includes(child):
+            yield include
+
+
 class Template(tornado.template.Template):
     def __init__(self, template_string, source_string, name="<string>", loader=None,
                  compress_whitespace=None, autoescape=tornado.template._UNSET):
         # new parameter "source_string" is added which contains code file content
         self.source_string = source_string.decode('utf-8')
-        tornado.template.Template.__init__(self, template_string, name, loader, compress_whitespace, autoescape)
+
+        # HERE IS THE MODIFICATION
+        # same as tornado.template.Template.__init__, except that the generated code is loaded from cache if possible
+        self.name = name
+        if compress_whitespace is None:
+            compress_whitespace = name.endswith(".html") or name.endswith(".js")
+        if autoescape is not tornado.template._UNSET:
+            self.autoescape = autoescape
+        elif loader:
+            self.autoescape = loader.autoescape
+        else:
+            self.autoescape = tornado.template._DEFAULT_AUTOESCAPE
+        self.namespace = loader.namespace if loader else {}
+        reader = tornado.template._TemplateReader(name,
+            _compile_cache_directives(tornado.escape.native_str(template_string), name))
+        self.file = tornado.template._File(self, tornado.template._parse(reader, self))
+        self.loader = loader
+        # files and templates this template is compiled from, see Loader.load
+        self.files = {}
+        self.dependencies = {}
+        self.digest = self._get_digest(template_string, loader, compress_whitespace)
+        cache = getattr(loader, 'cache', None)
+        compiled = cache.load(name, self.digest) if cache else None
+        if compiled:
+            self.code, self.compiled = compiled
+        else:
+            self.code = self._generate_python(loader, compress_whitespace)
+            try:
+                self.compiled = compile(
+                    tornado.escape.to_unicode(self.code),
+                    "%s.generated.py" % self.name.replace('.', '_'),
+                    "exec")
+            except Exception:
+                self._dump_code(logging.ERROR)
+                raise
+            if cache:
+                cache.save(name, self.digest, self.code, self.compiled)
+
+        # debug output the final code generated by engine, once per compilation instead of once per rendering
+        if getattr(loader, 'debug_dump', False):
+            self._dump_code(logging.DEBUG)
+
+        # namespace which is the same for every rendering, see tornado.template.Template.generate
+        self.base_namespace = {
+            "escape": tornado.escape.xhtml_escape,
+            "xhtml_escape": tornado.escape.xhtml_escape,
+            "url_escape": tornado.escape.url_escape,
+            "json_encode": tornado.escape.json_encode,
+            "squeeze": tornado.escape.squeeze,
+            "linkify": tornado.escape.linkify,
+            "datetime": datetime,
+            "_utf8": tornado.escape.utf8,
+            "_flush_buffer": _flush_buffer,
+            "_cache_fragment": _cache_fragment,
+            "cached": cached,
+            "_string_types": (str, bytes),
+            "__name__": self.name.replace('.', '_'),
+            "__loader__": tornado.util.ObjectDict(get_source=lambda name: self.code),
+        }
+        self.base_namespace.update(self.namespace)
+
+        # HERE IS THE MODIFICATION
+        # code file is executed only once as a module, then names defined in code files of ancestors and self are
+        # layered, child overrides parent
+        self.module = None
+        if self.source_string:
+            self.module = _ModuleNamespace(self.base_namespace)
+            del self.module["__loader__"]
+            # a template may be compiled during another rendering, whose names must not be seen
+            _render({}, exec, compile(self.source_string, self._get_source_path(loader), "exec"), self.module)
+        layers = [ancestor.template for ancestor in reversed(self._get_ancestors(loader))
+                  if ancestor.template.module is not None]
+        self.code_namespace = {}
+        for layer in layers:
+            for k, v in layer.module.items():
+                if not k.startswith('__') and layer.base_namespace.get(k) is not v:
+                    self.code_namespace[k] = v
+        # "_execute" is bound to the namespace of each rendering, functions of code files look names up in it by
+        # _ModuleNamespace
+        generated = {}
+        exec(self.compiled, generated)
+        self.functions = [(k, v) for k, v in generated.items() if isinstance(v, types.FunctionType)]
+
+    def _get_source_path(self, loader):
+        if loader and hasattr(loader, 'root'):
+            return os.path.join(loader.root, self.name) + '.py'
+        return self.name + '.py'
+
+    def _dump_code(self, level):
+        if logging.getLogger().isEnabledFor(level):
+            formatted_code = tornado.template._format_code(self.code).rstrip()
+            logging.log(level, "%s code:\n%s", self.name, formatted_code)
+
+    def _get_digest(self, template_string, loader, compress_whitespace):
+        """
+        hash of everything the generated code depends on: content of this template and its code file,
+        digests of its parent and included templates, options, and versions of Python and Tornado
+        """
+        h = hashlib.sha1()
+        stream_chunk_size = getattr(loader, 'stream_chunk_size', None)
+        for part in (sys.version, tornado.version, repr(_CODE_VERSION), repr(self.autoescape),
+                     repr(compress_whitespace), repr(stream_chunk_size)):
+            h.update(part.encode())
+            h.update(b'\0')
+        h.update(template_string)
+        h.update(b'\0')
+        h.update(self.source_string.encode())
+        if loader:
+            names = [(chunk.name, self.name) for chunk in self.file.body.chunks
+                     if isinstance(chunk, tornado.template._ExtendsBlock)]
+            names += [(include.name, include.template_name) for include in _find_includes(self.file)]
+            for name, parent_path in names:
+                dependency = loader.load(name, parent_path)
+                self.dependencies[dependency.name] = dependency
+                h.update(dependency.digest.encode())
+        return h.hexdigest()
 
     def _generate_python(self, loader, compress_whitespace):
         buffer = io.StringIO()
@@ -138,22 +716,249 @@ class Template(tornado.template.Template):
             ancestors[0].generate(writer)
 
             # HERE IS THE MODIFICATION
-            # attach code file content, from ancestor to self
-            # template inheritance works perfectly
-            for ancestor in ancestors:
-                buffer.write('\n\n')
-                buffer.write(ancestor.template.source_string)
+            # generate streaming version of "_execute" if needed
+            stream_chunk_size = getattr(loader, 'stream_chunk_size', None)
+            if stream_chunk_size:
+                writer = _StreamCodeWriter(buffer, named_blocks, loader, ancestors[0].template,
+                    compress_whitespace, stream_chunk_size)
+                writer.write_file(ancestors[0])
 
             return buffer.getvalue()
         finally:
             buffer.close()
 
+    def _get_namespace(self, kwargs):
+        """
+        namespace of one rendering, names in code files override arguments
+        """
+        namespace = self.base_namespace.copy()
+        namespace.update(kwargs)
+        namespace.update(self.code_namespace)
+        for name, function in self.functions:
+            bound = types.FunctionType(function.__code__, namespace, name, function.__defaults__,
+                function.__closure__)
+            bound.__kwdefaults__ = function.__kwdefaults__
+            namespace[name] = bound
+        return namespace
+
     def generate(self, **kwargs):
         # HERE IS THE MODIFICATION
-        # debug output the final code generated by engine
-        formatted_code = tornado.template._format_code(self.code).rstrip()
-        logging.debug("%s code:\n%s", self.name, formatted_code)
-        return tornado.template.Template.generate(self, **kwargs)
+        # fast path of tornado.template.Template.generate, the namespace is copied from a prepared one, and
+        # compiled functions are bound to it without executing code again or clearing linecache
+        namespace = self._get_namespace(kwargs)
+        try:
+            return _render(namespace, namespace["_execute"])
+        except Exception:
+            self._dump_code(logging.ERROR)
+            raise
+
+    def generate_stream(self, **kwargs):
+        """
+        generate output chunk by chunk, as an iterator of bytes
+        if loader is not created with "stream_chunk_size", whole output is generated as one chunk
+        """
+        namespace = self._get_namespace(kwargs)
+        execute = namespace.get("_execute_stream")
+        try:
+            if execute:
+                # other renderings may run between chunks, so each chunk is generated as the current rendering
+                chunks = execute()
+                while True:
+                    chunk = _render(namespace, next, chunks, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+            else:
+                yield _render(namespace, namespace["_execute"])
+        except Exception:
+            self._dump_code(logging.ERROR)
+            raise
+
+
+def _flush_buffer(buffer, size):
+    """
+    used by streaming template, take out the whole buffer if it has at least "size" bytes
+    """
+    if size and sum(map(len, buffer)) < size:
+        return None
+    chunk = b''.join(buffer)
+    del buffer[:]
+    return chunk
+
+
+class _StreamCodeWriter(tornado.template._CodeWriter):
+    """
+    writes "_execute_stream", a generator version of "_execute" which yields output:
+    1. after "</head>", so that browser can load scripts and styles while the body is still being generated
+    2. at the end of included templates and blocks, and at the beginning of each loop, if output is large enough
+    except inside "{% apply %}" and "{% cache %}"
+    """
+
+    def __init__(self, file, named_blocks, loader, current_template, compress_whitespace, chunk_size):
+        tornado.template._CodeWriter.__init__(self, file, named_blocks, loader, current_template,
+            compress_whitespace)
+        self.chunk_size = chunk_size
+        # what the next indented block is, ("loop", line), ("fragment", line) or ("function", line)
+        self.next_block = None
+        # count of nested functions (generated by "apply") where "yield" is not allowed, and cached fragments
+        # where output must be kept in buffer
+        self.unflushable_depth = 0
+
+    def write_file(self, file):
+        # it's the generator itself, not a nested function
+        tornado.template._CodeWriter.write_line(self, "def _execute_stream():", file.line)
+        with self.indent():
+            self.write_line("_buffer = []", file.line)
+            self.write_line("_append = _buffer.append", file.line)
+            file.body.generate(self)
+            self.write_line("yield _utf8('').join(_buffer)", file.line)
+
+    def write_flush(self, line_number, size):
+        if not self.unflushable_depth:
+            self.write_line("_chunk = _flush_buffer(_buffer, %d)" % size, line_number)
+            self.write_line("if _chunk: yield _chunk", line_number)
+
+    def write_line(self, line, line_number, indent=None):
+        tornado.template._CodeWriter.write_line(self, line, line_number, indent)
+        if line.startswith("for _fragment in _cache_fragment("):
+            self.next_block = ("fragment", line_number)
+        elif line.startswith("for ") or line.startswith("while "):
+            self.next_block = ("loop", line_number)
+        elif line.startswith("def "):
+            self.next_block = ("function", line_number)
+        elif line.startswith("_append(") and "</head>" in line:
+            self.write_flush(line_number, 0)
+
+    def indent(self):
+        writer = self
+        block, self.next_block = self.next_block, None
+
+        class Indenter():
+            def __enter__(_):
+                writer._indent += 1
+                if block and block[0] in ("function", "fragment"):
+                    writer.unflushable_depth += 1
+                elif block and block[0] == "loop":
+                    writer.write_flush(block[1], writer.chunk_size)
+                return writer
+
+            def __exit__(_, *args):
+                if block and block[0] in ("function", "fragment"):
+                    writer.unflushable_depth -= 1
+                writer._indent -= 1
+
+        return Indenter()
+
+    def include(self, template, line):
+        writer = self
+        included = tornado.template._CodeWriter.include(self, template, line)
+
+        class IncludeTemplate():
+            def __enter__(_):
+                return included.__enter__()
+
+            def __exit__(_, *args):
+                writer.write_flush(line, writer.chunk_size)
+                return included.__exit__(*args)
+
+        return IncludeTemplate()
+
+
+class CredentialCache():
+    """
+    cache of verified HTTP basic authentication, see "authentication_cache_ttl" and "authentication_cookie" settings
+    Authorization header is kept as its HMAC with a random key, so that passwords are not kept in memory
+    call invalidate(username) after password of a user is changed, which also invalidates session cookies of that
+    user issued by this process
+    session cookies contain a random value of the process which issues them, so they are not valid after restart,
+    nor in other processes, then the user is verified again
+    """
+
+    def __init__(self, size):
+        self.__cache = LRUCache(size)
+        self.__key = os.urandom(32)
+        # increased by invalidate(), cached items and cookies of older generation are not valid
+        self.__epoch = 0
+        self.__generations = {}
+        # random value of current process, see __nonce()
+        self.__pid = None
+        self.__nonce_value = None
+
+    @property
+    def size(self):
+        return self.__cache.size
+
+    @size.setter
+    def size(self, size):
+        self.__cache.size = size
+
+    @property
+    def hits(self):
+        return self.__cache.hits
+
+    @property
+    def misses(self):
+        return self.__cache.misses
+
+    def __generation(self, username):
+        return self.__epoch, self.__generations.get(username, 0)
+
+    def __nonce(self):
+        """
+        random value of current process, which is created again after forking
+        """
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__nonce_value = base64.urlsafe_b64encode(os.urandom(12)).decode()
+        return self.__nonce_value
+
+    def get(self, header):
+        """
+        return user name if Authorization header is verified, or None
+        """
+        item = self.__cache.get(hmac.new(self.__key, header.encode(), hashlib.sha256).digest())
+        if item and item[1] == self.__generation(item[0]):
+            return item[0]
+        return None
+
+    def set(self, header, username, ttl):
+        self.__cache.set(hmac.new(self.__key, header.encode(), hashlib.sha256).digest(),
+            (username, self.__generation(username)), ttl)
+
+    def invalidate(self, username=None):
+        """
+        invalidate a user, or all the users if username is None
+        """
+        if username is None:
+            self.__epoch += 1
+            self.__generations.clear()
+            self.__cache.invalidate()
+        else:
+            self.__generations[username] = self.__generations.get(username, 0) + 1
+
+    def create_cookie_value(self, username):
+        return '%s:%d:%d:%s' % ((self.__nonce(),) + self.__generation(username) + (username,))
+
+    def check_cookie_value(self, value):
+        """
+        return user name if the value of session cookie is still valid, or None
+        """
+        try:
+            nonce, epoch, generation, username = value.decode().split(':', 3)
+            if nonce == self.__nonce() and (int(epoch), int(generation)) == self.__generation(username):
+                return username
+        except Exception:
+            pass
+        return None
+
+
+# default size of credential_cache, see "authentication_cache_size" setting
+DEFAULT_CREDENTIAL_CACHE_SIZE = 1024
+
+# default seconds of session cookie, see "authentication_cookie_max_age" setting
+DEFAULT_AUTHENTICATION_COOKIE_MAX_AGE = 86400
+
+credential_cache = CredentialCache(DEFAULT_CREDENTIAL_CACHE_SIZE)
 
 
 def authenticated(method):
@@ -166,18 +971,34 @@ def authenticated(method):
     def wrapper(self, *args, **kwargs):
         authentication_method = self.settings.get('authentication')
         if authentication_method:
-            try:
-                auth_header = self.request.headers['Authorization']
-                decoded = base64.b64decode(auth_header[6:].encode()).decode().split(':')
-                username = decoded[0]
-                password = decoded[1]
-                if authentication_method(username, password):
-                    self._current_user = username
-                else:
+            self._current_user = None
+            # session cookie issued after basic authentication, verification is skipped if it is valid
+            cookie_name = self.settings.get('authentication_cookie')
+            if cookie_name:
+                max_age = self.settings.get('authentication_cookie_max_age') or DEFAULT_AUTHENTICATION_COOKIE_MAX_AGE
+                value = self.get_secure_cookie(cookie_name, max_age_days=max_age / 86400.0)
+                if value:
+                    self._current_user = credential_cache.check_cookie_value(value)
+            if not self._current_user:
+                try:
+                    auth_header = self.request.headers['Authorization']
+                    cache_ttl = self.settings.get('authentication_cache_ttl')
+                    if cache_ttl:
+                        self._current_user = credential_cache.get(auth_header)
+                    if not self._current_user:
+                        decoded = base64.b64decode(auth_header[6:].encode()).decode().split(':')
+                        username = decoded[0]
+                        password = decoded[1]
+                        if authentication_method(username, password):
+                            self._current_user = username
+                            if cache_ttl:
+                                credential_cache.set(auth_header, username, cache_ttl)
+                    if self._current_user and cookie_name:
+                        self.set_secure_cookie(cookie_name, credential_cache.create_cookie_value(self._current_user),
+                            expires_days=None, httponly=True)
+                except Exception as ex:
+                #                logging.warning(ex)
                     self._current_user = None
-            except Exception as ex:
-            #                logging.warning(ex)
-                self._current_user = None
 
             if not self._current_user:
                 self.set_header('WWW-Authenticate', 'Basic')
@@ -187,6 +1008,7 @@ def authenticated(method):
                     self.write_html_file(filename)
                 else:
                     self.write(b'Unauthenticated')
+                self.finish()
                 return
 
         return method(self, *args, **kwargs)
@@ -194,6 +1016,81 @@ def authenticated(method):
     return wrapper
 
 
+class AuthorizationCache():
+    """
+    cache of results of "authorization" function, keyed by user and normalized path, see "authorization_cache_ttl"
+    setting
+    call invalidate(user) after permissions of a user are changed
+    """
+
+    def __init__(self, size):
+        self.__cache = LRUCache(size)
+        # increased by invalidate(), cached results of older generation are not valid
+        self.__generations = {}
+
+    @property
+    def size(self):
+        return self.__cache.size
+
+    @size.setter
+    def size(self, size):
+        self.__cache.size = size
+
+    @property
+    def hits(self):
+        return self.__cache.hits
+
+    @property
+    def misses(self):
+        return self.__cache.misses
+
+    def get(self, user, path):
+        """
+        return True or False if cached, otherwise None
+        """
+        item = self.__cache.get((user, path))
+        if item and item[1] == self.__generations.get(user, 0):
+            return item[0]
+        return None
+
+    def set(self, user, path, authorized, ttl):
+        self.__cache.set((user, path), (authorized, self.__generations.get(user, 0)), ttl)
+
+    def invalidate(self, user=None):
+        """
+        invalidate a user, or all the users if user is None
+        """
+        if user is None:
+            self.__cache.invalidate()
+        else:
+            self.__generations[user] = self.__generations.get(user, 0) + 1
+
+
+# default size of authorization_cache, see "authorization_cache_size" setting
+DEFAULT_AUTHORIZATION_CACHE_SIZE = 4096
+
+authorization_cache = AuthorizationCache(DEFAULT_AUTHORIZATION_CACHE_SIZE)
+
+
+def is_authorized(handler):
+    """
+    call "authorization" function, or get the result from authorization_cache
+    """
+    authorization_method = handler.settings.get('authorization')
+    if not authorization_method:
+        return True
+    cache_ttl = handler.settings.get('authorization_cache_ttl')
+    if not cache_ttl:
+        return authorization_method(handler.current_user, handler.request.path)
+    normalizer = handler.settings.get('authorization_path_normalizer')
+    path = normalizer(handler.request.path) if normalizer else handler.request.path
+    authorized = authorization_cache.get(handler.current_user, path)
+    if authorized is None:
+        authorized = bool(authorization_method(handler.current_user, handler.request.path))
+        authorization_cache.set(handler.current_user, path, authorized, cache_ttl)
+    return authorized
+
+
 def authorized(method):
     """
     decorator to check whether a user can visit this url
@@ -201,14 +1098,14 @@ def authorized(method):
 
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        authorization_method = self.settings.get('authorization')
-        if authorization_method and not authorization_method(self.current_user, self.request.path):
+        if not is_authorized(self):
             self.set_status(403)
             filename = self.application.settings.get('unauthorized_response_file')
             if filename:
                 self.write_html_file(filename)
             else:
                 self.write(b'Unauthorized')
+            self.finish()
             return
 
         return method(self, *args, **kwargs)
@@ -221,11 +1118,15 @@ class TemplateHandler(RequestHandler):
     enhanced template handler
     """
 
+    @tornado.web.asynchronous
     @authenticated
     @authorized
     def get(self, *args, **kwargs):
         path = args[0]
-        self.render(path)
+        if self.settings.get('template_streaming'):
+            self.render_stream(path)
+        else:
+            self.render(path)
 
     @authenticated
     @authorized
@@ -251,6 +1152,288 @@ class ForbiddenFileHandler(RequestHandler):
         raise tornado.web.HTTPError(404)
 
 
+# content types worth compressing
+COMPRESSIBLE_TYPES = tornado.web.GZipContentEncoding.CONTENT_TYPES | set(["image/svg+xml"])
+
+# files smaller than it are not compressed
+COMPRESS_MIN_SIZE = 1024
+
+# Content-Encoding -> file name suffix of precompressed file, in order of preference
+COMPRESSED_SUFFIXES = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+# Content-Encoding -> (level used at runtime, level used by tore.precompress())
+COMPRESS_LEVELS = {'gzip': (6, 9), 'br': (5, 11)}
+
+# bytes read from disk at a time when a static file is too large to be cached
+STATIC_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def compress(data, encoding, best=False):
+    """
+    compress data with Content-Encoding "gzip" or "br", return None if not supported
+    best compression is much slower, use it only at deploy time
+    """
+    level = COMPRESS_LEVELS.get(encoding, (None, None))[1 if best else 0]
+    if encoding == 'gzip':
+        return gzip.compress(data, level)
+    if encoding == 'br' and brotli:
+        return brotli.compress(data, quality=level)
+    return None
+
+
+def is_compressible(path, size):
+    mime_type, encoding = mimetypes.guess_type(path)
+    # already compressed files such as "jquery.js.gz" have encoding
+    return size >= COMPRESS_MIN_SIZE and mime_type in COMPRESSIBLE_TYPES and not encoding
+
+
+class CachedFile():
+    """
+    content of a file in FileCache
+    if the file is too large to be cached, data is None and the file is read by read_chunks()
+    """
+
+    def __init__(self, path, stat_result, load=True):
+        self.path = path
+        self.mtime = stat_result.st_mtime
+        self.length = stat_result.st_size
+        self.modified = datetime.datetime.fromtimestamp(int(stat_result.st_mtime))
+        self.mime_type = mimetypes.guess_type(path)[0]
+        self.compressible = is_compressible(path, self.length)
+        if load:
+            with open(path, 'rb') as f:
+                self.data = f.read()
+            self.etag = '"%s"' % hashlib.sha1(self.data).hexdigest()
+        else:
+            self.data = None
+            self.etag = '"%x-%x"' % (int(self.mtime * 1000000), self.length)
+        # Content-Encoding -> compressed data, or None if it is not worth, filled by FileCache.encode()
+        self.encodings = {}
+        self.size = self.length
+
+    def read_chunks(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(STATIC_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def compress(self, encoding):
+        """
+        read precompressed file if it is not older than the file, otherwise compress data now
+        """
+        suffix = COMPRESSED_SUFFIXES[encoding]
+        try:
+            if os.stat(self.path + suffix).st_mtime >= self.mtime:
+                with open(self.path + suffix, 'rb') as f:
+                    return f.read()
+        except EnvironmentError:
+            pass
+        compressed = compress(self.data, encoding)
+        if compressed is not None and len(compressed) < len(self.data):
+            return compressed
+        return None
+
+
+class FileCache():
+    """
+    memory cache of files bounded by total bytes, least recently used files are removed first
+    file is read again if its modification time or size is changed
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # path -> CachedFile, least recently used first
+        self.__files = collections.OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def get(self, path):
+        """
+        return CachedFile, raise EnvironmentError if the file cannot be read
+        too large files are not cached nor read, see CachedFile.read_chunks()
+        """
+        stat_result = os.stat(path)
+        with self.__lock:
+            cached = self.__files.get(path)
+            if cached and cached.mtime == stat_result.st_mtime and cached.length == stat_result.st_size:
+                self.__files.move_to_end(path)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        if stat_result.st_size > self.size:
+            with self.__lock:
+                self.__remove(path)
+            return CachedFile(path, stat_result, False)
+        cached = CachedFile(path, stat_result)
+        with self.__lock:
+            self.__remove(path)
+            self.__files[path] = cached
+            self.__bytes += cached.size
+            self.__shrink()
+        return cached
+
+    def encode(self, cached, encoding):
+        """
+        return data of CachedFile compressed with Content-Encoding, or None if it is not worth
+        compressed only once when it is requested, and only if the file is still cached
+        """
+        with self.__lock:
+            if encoding in cached.encodings:
+                return cached.encodings[encoding]
+            if not cached.compressible or self.__files.get(cached.path) is not cached:
+                return None
+        compressed = cached.compress(encoding)
+        with self.__lock:
+            if encoding not in cached.encodings and self.__files.get(cached.path) is cached:
+                cached.encodings[encoding] = compressed
+                if compressed is not None:
+                    cached.size += len(compressed)
+                    self.__bytes += len(compressed)
+                    self.__shrink()
+        return compressed
+
+    def __shrink(self):
+        while self.__bytes > self.size:
+            self.__remove(next(iter(self.__files)))
+
+    def __remove(self, path):
+        cached = self.__files.pop(path, None)
+        if cached:
+            self.__bytes -= cached.size
+
+    def invalidate(self, path=None):
+        """
+        remove a file, or all the files if path is None
+        """
+        with self.__lock:
+            if path is None:
+                self.__files.clear()
+                self.__bytes = 0
+            else:
+                self.__remove(path)
+
+
+# default size of file_cache in bytes, see "static_cache_size" setting
+DEFAULT_FILE_CACHE_SIZE = 16 * 1024 * 1024
+
+# cache of static files
+file_cache = FileCache(DEFAULT_FILE_CACHE_SIZE)
+
+
+class StaticFileHandler(tornado.web.StaticFileHandler):
+    """
+    serves static files from file_cache, with precompressed content and strong ETag
+    files requested with argument "v" are cached by browser forever, see tornado.web.StaticFileHandler
+    """
+
+    @tornado.web.asynchronous
+    def get(self, path, include_body=True):
+        path = self.parse_url_path(path)
+        abspath = os.path.abspath(os.path.join(self.root, path))
+        # os.path.abspath strips a trailing /
+        # it needs to be temporarily added back for requests to root/
+        if not (abspath + os.path.sep).startswith(self.root):
+            raise tornado.web.HTTPError(403, "%s is not in root static directory", path)
+        if self.default_filename is not None and os.path.isdir(abspath):
+            if not self.request.path.endswith("/"):
+                self.redirect(self.request.path + "/")
+                return
+            abspath = os.path.join(abspath, self.default_filename)
+        try:
+            cached = file_cache.get(abspath)
+        except EnvironmentError:
+            if os.path.isdir(abspath):
+                raise tornado.web.HTTPError(403, "%s is not a file", path)
+            raise tornado.web.HTTPError(404)
+
+        chunks = self.__respond(path, cached, include_body)
+        if chunks is None:
+            self.finish()
+        else:
+            self.__write_chunks(chunks)
+
+    def __respond(self, path, cached, include_body):
+        """
+        set headers, return iterable of body chunks if the file should be read from disk
+        """
+        self.set_header("Last-Modified", cached.modified)
+        if cached.mime_type:
+            self.set_header("Content-Type", cached.mime_type)
+        cache_time = self.get_cache_time(path, cached.modified, cached.mime_type)
+        if cache_time > 0:
+            self.set_header("Expires", datetime.datetime.utcnow() + datetime.timedelta(seconds=cache_time))
+            self.set_header("Cache-Control", "public, max-age=%d" % cache_time)
+        else:
+            self.set_header("Cache-Control", "public")
+        self.set_extra_headers(path)
+
+        # each encoding has its own strong ETag
+        encoding, data = self.__get_encoding(cached)
+        if cached.compressible and cached.data is not None:
+            self.set_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+            etag = '%s-%s"' % (cached.etag[:-1], encoding)
+        else:
+            etag = cached.etag
+            data = cached.data
+        self.set_header("Etag", etag)
+
+        inm_value = self.request.headers.get("If-None-Match")
+        if inm_value is not None:
+            if inm_value.strip() == '*' or etag in [i.strip() for i in inm_value.split(',')]:
+                self.set_status(304)
+                return None
+        else:
+            ims_value = self.request.headers.get("If-Modified-Since")
+            if ims_value is not None:
+                date_tuple = email.utils.parsedate(ims_value)
+                if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+                if if_since >= cached.modified:
+                    self.set_status(304)
+                    return None
+
+        if data is None:
+            # too large to be cached, Content-Length also prevents compressing by "gzip" setting
+            self.set_header("Content-Length", cached.length)
+            if include_body:
+                return cached.read_chunks()
+        elif include_body:
+            self.write(data)
+        else:
+            assert self.request.method == "HEAD"
+            self.set_header("Content-Length", len(data))
+        return None
+
+    def __write_chunks(self, chunks):
+        """
+        write next chunk after previous one is sent, so that a large file is not read into memory
+        """
+        for chunk in chunks:
+            self.write(chunk)
+            self.flush(callback=functools.partial(self.__write_chunks, chunks))
+            return
+        self.finish()
+
+    def __get_encoding(self, cached):
+        """
+        choose the preferred encoding accepted by client, return (encoding, data)
+        """
+        if cached.data is None or not cached.compressible:
+            return None, cached.data
+        accepted = set(i.split(';')[0].strip() for i in self.request.headers.get("Accept-Encoding", "").split(','))
+        for encoding in COMPRESSED_SUFFIXES:
+            if encoding in accepted:
+                data = file_cache.encode(cached, encoding)
+                if data is not None:
+                    return encoding, data
+        return None, cached.data
+
+
 class Application(tornado.web.Application):
     """
     enhanced Application class used by tore.start_server()
@@ -270,12 +1453,27 @@ class Application(tornado.web.Application):
         # used by TemplateHandler
         _settings['template_path'] = _settings['web_root_dir']
 
+        # raise if the codec is not installed
+        tore.codec.select(_settings.get('json_codec'))
+
+        if _settings.get('fragment_cache_size'):
+            fragment_cache.size = _settings['fragment_cache_size']
+
+        if _settings.get('authentication_cache_size'):
+            credential_cache.size = _settings['authentication_cache_size']
+
+        if _settings.get('authorization_cache_size'):
+            authorization_cache.size = _settings['authorization_cache_size']
+
+        if _settings.get('static_cache_size') is not None:
+            file_cache.size = _settings['static_cache_size']
+
         _handlers = [
             # some default handlers
             ('/', tornado.web.RedirectHandler, dict(url='/web/index.t')),
             ('/web/(.*?\.t)', TemplateHandler),
             ('/web/.*?\.py', ForbiddenFileHandler),
-            ('/web/(.*)', tornado.web.StaticFileHandler, dict(path=_settings.get('web_root_dir'))),
+            ('/web/(.*)', StaticFileHandler, dict(path=_settings.get('web_root_dir'))),
             # message service url
             ('/messaging', tore.messaging.WebSocketHandler)
         ]
@@ -1,4 +1,5 @@
 import platform
 
+@cached(60)
 def get_platform():
     return platform.platform()
\ No newline at end of file